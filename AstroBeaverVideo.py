@@ -18,13 +18,29 @@ import os
 import sys
 import io
 import time
+import threading
+
+# startup time stamps, (stage, seconds since launch, thread), printed by startup_report()
+STARTUP_START = time.monotonic()
+STARTUP_MARKS = []
+
+def startup_mark(stage):
+    '''
+    Records the time a stage of the startup was finished, may be called from any thread
+    '''
+    STARTUP_MARKS.append((stage, time.monotonic() - STARTUP_START, threading.current_thread().name))
+
+# only the modules needed for the main window are imported here, PIL, NumPy, picamera and the
+# capture helpers are imported by the functions using them to keep the launch fast
 import PySimpleGUI as sg
-from PIL import Image
 from time import sleep
-import picamera
 from datetime import datetime
 from pathlib import Path
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import catalog
+import jobqueue
+
+startup_mark('imports')
 
 # get the home directory
 home = str(Path.home())
@@ -38,9 +54,6 @@ sg.SetOptions(element_padding=(0, 0),
               input_text_color ='Red',
               button_color = ('Black', 'Red')) 
 
-# grab the resolution of the screen the program is being run on
-SCREEN_WIDTH, SCREEN_HEIGHT = sg.Window.get_screen_size()
-
 # put all key parameters in their own class, Parameters
 class Parameters:
     # default image settings
@@ -53,12 +66,30 @@ class Parameters:
     default_iso             = 0
     #default_time_step       = 2
     default_vid_time        = 30
+    compress_raw            = False # store raw YUV in the lossless compressed container (.abr)
+    compress_workers        = 3     # compression threads, the Pi 3B+ has four cores
     #default_image_size      = (int(SCREEN_HEIGHT/2), int(SCREEN_HEIGHT/2))
-    default_preview_size    = (int(SCREEN_HEIGHT/2), int(SCREEN_HEIGHT/2))
+    default_preview_size    = (350,300)
+    camera_warmup           = 3     # seconds the camera needs after the preview started before it is used
     #default_save_folder     = "{}/images".format(os.getcwd())
     #default_save_folder_vid = "{}/videos".format(os.getcwd())
     default_save_folder     = "{}/images".format("/media/sruell/46CA-8C72")
     default_save_folder_vid = "{}/videos".format("/media/sruell/46CA-8C72")
+    catalog_name            = ".catalog/captures.db"    # capture catalog, stored in a hidden folder below the video folder
+    calibration_folder      = "calibration"     # master darks, flats and bias, stored below the video folder
+    jobs_name               = ".catalog/jobs.db"        # queue of post-capture jobs
+    thumbnail_folder        = ".catalog/thumbs"         # thumbnails of the raw captures
+    job_workers             = 1     # low priority processes running the post-capture jobs
+    job_cpus                = {3}   # CPU cores the post-capture jobs may use
+    default_cal_frames      = 50
+    default_burst_frames    = 10
+    raw_buffers             = 4     # preallocated raw frame buffers of the burst mode
+    raw_workers             = 3     # DNG writer processes of the burst mode
+    default_interval        = 5     # seconds between two time-lapse frames
+    default_interval_frames = 720
+    interval_buffers        = 4     # preallocated frame buffers of the time-lapse mode
+    default_panel_time      = 10    # seconds per mosaic panel
+    mosaic_overlap          = 0.2   # minimum overlap of neighbouring mosaic panels (fraction of the panel size)
     recordingResolutions = [(4056,3040),(3840,2880),(3840,2160),(2560,1440),(2560,1920),(2028,1520),(2028,1080),(1920,1440),(1920,1088),(1664,1248),(1332,990),(1280,960),(1280,720),(640,320)]
     sensorModes = [
     [0, 1, 2, 3, 4],    #modes
@@ -91,7 +122,8 @@ def create_layout(parameters):
     p=parameters
 
     # ------ Menu Definition ------ #      
-    menu_def = [['Menu', ['Save Location', 'Exit']],
+    menu_def = [['Menu', ['Save Location', 'Browse Captures', 'Exit']],
+                ['Capture', ['Mosaic', 'Time-lapse', 'Raw Burst', 'Calibration']],
                 ['Date-Time',['Set Date-Time']]]     
 
     # define the column layout for the GUI
@@ -151,7 +183,112 @@ def create_layout(parameters):
 
     return layout
     
+def roi_geometry(parameters, preview_size):
+    '''
+    Precomputes the region of interest geometry of every sensor mode and recording resolution
+
+    The table is built once per preview size, so roi_window() only looks the geometry up while
+    the user steps through the resolutions.
+
+    Parameters
+    ----------
+    parameters   : Class
+                   A class of the parameters used within the program
+
+    preview_size : tuple
+                   Width and height of the live preview window
+
+    Returns
+    -------
+    table        : dict
+                   (sensor mode, resolution) -> dict with the sensor resolution ('sensor'), the zoom
+                   factors ('factors'), the size of the ROI rectangle on the preview ('preview'), the
+                   block aligned frame size ('padded'), whether the resolution fits the sensor mode
+                   ('valid') and for valid entries the position in steps ('step')
+
+    steps        : dict
+                   sensor mode -> list of the valid resolutions, largest first
+    '''
+    key = (parameters, tuple(preview_size))
+    if key not in _roi_geometry_cache:
+        preview_width, preview_height = preview_size
+        table = {}
+        steps = {}
+        for sensor_mode in parameters.sensorModes[0]:
+            # 'auto' selects the mode from the resolution, the full sensor of the hq camera is the limit
+            sensor = parameters.sensorModes[1][sensor_mode] if sensor_mode != 0 else (4056,3040)
+            steps[sensor_mode] = []
+            for resolution in parameters.recordingResolutions:
+                factors = (resolution[0] / sensor[0], resolution[1] / sensor[1])
+                entry = {
+                    'sensor'  : sensor,
+                    'factors' : factors,
+                    'preview' : (round(preview_width * factors[0]), round(preview_height * factors[1])),
+                    'padded'  : _pad(resolution),
+                    'valid'   : resolution[0] <= sensor[0] and resolution[1] <= sensor[1],
+                }
+                if entry['valid']:
+                    entry['step'] = len(steps[sensor_mode])
+                    steps[sensor_mode].append(resolution)
+                table[(sensor_mode, resolution)] = entry
+        _roi_geometry_cache[key] = (table, steps)
+    return _roi_geometry_cache[key]
+
+# tables of roi_geometry(), keyed by parameters and preview size
+_roi_geometry_cache = {}
+
+def configure_camera(camera, sensor_mode=None, resolution=None):
+    '''
+    Sets sensor mode and recording resolution with a single restart of the camera pipeline
+
+    Setting camera.sensor_mode and camera.resolution one after the other restarts the pipeline
+    twice, so if both change they are configured together. Unchanged values are not written.
+    This uses internals of picamera, which is why exactly picamera 1.13 is required.
+
+    Parameters
+    ----------
+    camera      : picamera.camera.PiCamera
+                  The picamera camera object
+
+    sensor_mode : int
+                  The new sensor mode, None keeps the current one
+
+    resolution  : tuple
+                  The new recording resolution, None keeps the current one
+
+    Returns
+    -------
+    None
+    '''
+    if sensor_mode == camera.sensor_mode:
+        sensor_mode = None
+    if resolution is not None and tuple(resolution) == tuple(camera.resolution):
+        resolution = None
+    
+    if sensor_mode is not None and resolution is not None and hasattr(camera, '_configure_camera'):
+        # the same steps as picamera's setters, but only once for both values
+        from picamera.mmalobj import to_resolution
+        camera._check_recording_stopped()
+        resolution = to_resolution(resolution)
+        old_sensor_mode = camera.sensor_mode
+        framerate = camera.framerate
+        if framerate == 0:
+            framerate = camera.framerate_range
+        clock_mode = camera.CLOCK_MODES[camera.clock_mode]
+        camera._disable_camera()
+        camera._configure_camera(sensor_mode=sensor_mode, framerate=framerate, resolution=resolution,
+                                 clock_mode=clock_mode, old_sensor_mode=old_sensor_mode)
+        camera._configure_splitter()
+        camera._enable_camera()
+    else:
+        if sensor_mode is not None:
+            camera.sensor_mode = sensor_mode
+        if resolution is not None:
+            camera.resolution = resolution
+
 def roi_window(parameters, camera):
+    from PIL import Image
+    
     # assign the parameters to name p for ease of use
     p=parameters
     
@@ -184,12 +321,12 @@ def roi_window(parameters, camera):
         sg.Text('Sensor Mode', size=(15,1), font=('Helvetica', 12, "bold"), pad=(0,p.pad_y)),
         ],
         [
-        sg.Combo(p.sensorModes[0], default_value=0,font=('Helvetica', p.font_size),  expand_x=False, enable_events=True,  readonly=False, key='sensor_mode'),
-        sg.Text(str(p.sensorModes[1][0]), size=(15,1), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='sensor_res'),
+        sg.Combo(p.sensorModes[0], default_value=camera.sensor_mode,font=('Helvetica', p.font_size),  expand_x=False, enable_events=True,  readonly=True, key='sensor_mode'),
+        sg.Text(str(p.sensorModes[1][camera.sensor_mode]), size=(15,1), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='sensor_res'),
         ],
         [
-        sg.Text(str(p.sensorModes[3][0]), size=(15,1), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='sensor_bin'),
-        sg.Text(str(p.sensorModes[2][0]), size=(15,1), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='sensor_fps'),
+        sg.Text(str(p.sensorModes[3][camera.sensor_mode]), size=(15,1), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='sensor_bin'),
+        sg.Text(str(p.sensorModes[2][camera.sensor_mode]), size=(15,1), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='sensor_fps'),
         ],
     ]
     
@@ -207,160 +344,124 @@ def roi_window(parameters, camera):
     ]
     
     window = sg.Window("Region Of Interest", layout, modal=False, location=(0,camera.preview.window[3]))
-    choice = None
     o = None #overlay
     roi_changed = False
     num_steps = 20
     zoom_pos_x = 0
-    zoom_pox_y = 0
-    factor_left = 0
-    factor_down = 0
-    factor_width = 1.0
-    factor_height = 1.0
-    sensor_mode = 0
-    sensor_width = 4056     #pi camera hq
-    sensor_height = 3040    #pi camera hq
+    zoom_pos_y = 0
+    
+    # all edits are staged and only shown on the overlay, the camera is reconfigured once on exit
+    preview_width = camera.preview.window[2]
+    preview_height = camera.preview.window[3]
+    table, steps = roi_geometry(p, (preview_width, preview_height))
+    sensor_mode = camera.sensor_mode
+    resolution = None # recording resolution to apply, None keeps the current one
+    # position in steps[sensor_mode], 0 is the full sensor mode resolution
+    step_index = table.get((sensor_mode, tuple(camera.resolution)), {}).get('step', 0)
     
     while True:
         event, values = window.read()
         
+        if event == "Exit" or event == sg.WIN_CLOSED:
+            break
+        
         if event == 'sensor_mode':
             sensor_mode = values['sensor_mode']
             window.find_element('sensor_res').Update(p.sensorModes[1][sensor_mode])
             window.find_element('sensor_fps').Update(p.sensorModes[2][sensor_mode])
             window.find_element('sensor_bin').Update(p.sensorModes[3][sensor_mode])
             
-            if(sensor_mode in [1,2,3,4]):
-                sensor_width = p.sensorModes[1][sensor_mode][0]
-                sensor_height = p.sensorModes[1][sensor_mode][1]
-            
-            recording_index = p.recordingResolutions.index((sensor_width,sensor_height));
-            recording_index_min = recording_index #recording resolution cannot be higher than current sensor mode allows
-            camera.sensor_mode = sensor_mode
-            if(sensor_mode in [1,2,3,4]):
-                camera.resolution = p.sensorModes[1][sensor_mode]
+            # recording resolution cannot be higher than the sensor mode allows
+            if sensor_mode != 0:
+                resolution = steps[sensor_mode][0]
+                step_index = 0
+            else:
+                resolution = None
+                step_index = table.get((sensor_mode, tuple(camera.resolution)), {}).get('step', 0)
             roi_changed = False #reset roi after sensor change
         
         if values['roi'] is True:
             print('Use region of interest')
-            preview_width = camera.preview.window[2]
-            preview_height = camera.preview.window[3]
-                                                
-            if(roi_changed is False):
-                recording_width = sensor_width
-                recording_height = sensor_height
-                recording_index = p.recordingResolutions.index((recording_width,recording_height));
-                recording_index_min = recording_index #recording resolution cannot be higher than current sensor mode allows
-                        
-            factor_width = recording_width / sensor_width
-            factor_height = recording_height / sensor_height
             
-            zoom_prev_width = round(preview_width * factor_width)
-            zoom_prev_height = round(preview_height * factor_height)
+            if event == '+' and step_index > 0:
+                step_index -= 1
+                resolution = steps[sensor_mode][step_index]
+                roi_changed = False
+                print('+ increase roi')
+            
+            if event == '-' and step_index < len(steps[sensor_mode]) - 1:
+                step_index += 1
+                resolution = steps[sensor_mode][step_index]
+                roi_changed = False
+                print('- decrease roi')
+            
+            geometry = table[(sensor_mode, steps[sensor_mode][step_index])]
+            zoom_prev_width, zoom_prev_height = geometry['preview']
             
             #place roi centered by default
             if(roi_changed is False):
                 zoom_pos_x = int((preview_width - zoom_prev_width)/2)
-                zoom_pos_y = int((preview_height - zoom_prev_height)/2);
-            
-            
-            if event == '+':
-                if(recording_index-1 >= recording_index_min):
-                    roi_changed = True
-                    recording_index -= 1
-                    resolution = p.recordingResolutions[recording_index]
-                    recording_width = resolution[0]
-                    recording_height = resolution[1]
-                    camera.resolution = resolution
-                    
-                    #recalc zoom
-                    factor_width = recording_width / sensor_width
-                    factor_height = recording_height / sensor_height
-                    zoom_prev_width = round(preview_width * factor_width)
-                    zoom_prev_height = round(preview_height * factor_height)
-                    zoom_pos_x = int((preview_width - zoom_prev_width)/2)
-                    zoom_pos_y = int((preview_height - zoom_prev_height)/2);
-                    print('+ increase roi')
-            
-            if event == '-':
-                if(recording_index+1 <= len(p.recordingResolutions)-1):
-                    roi_changed = True
-                    recording_index += 1
-                    resolution = p.recordingResolutions[recording_index]
-                    recording_width = resolution[0]
-                    recording_height = resolution[1]
-                    camera.resolution = resolution
-                    
-                    #recalc zoom
-                    factor_width = recording_width / sensor_width
-                    factor_height = recording_height / sensor_height
-                    zoom_prev_width = round(preview_width * factor_width)
-                    zoom_prev_height = round(preview_height * factor_height)
-                    zoom_pos_x = int((preview_width - zoom_prev_width)/2)
-                    zoom_pos_y = int((preview_height - zoom_prev_height)/2);
-                    print('- decrease roi')
+                zoom_pos_y = int((preview_height - zoom_prev_height)/2)
+                roi_changed = True
                 
             if event == 'UP':
                 step = int((preview_height - zoom_prev_height)/num_steps)
                 if(zoom_pos_y >= step):
                     zoom_pos_y -= step
-                    roi_changed = True
                     print('move roi UP -'+str(step)+'px')
                 
             if event == 'DWN':
                 step = int((preview_height - zoom_prev_height)/num_steps)
                 if(zoom_pos_y + zoom_prev_height + step <= preview_height):
                     zoom_pos_y += step
-                    roi_changed = True
                     print('move roi DOWN +'+str(step)+'px')
             
             if event == 'LFT':
                 step = int((preview_width - zoom_prev_width)/num_steps)
                 if(zoom_pos_x - step >= 0):
                     zoom_pos_x -= step
-                    roi_changed = True
                     print('move roi LEFT -'+str(step)+'px')
             
             if event == 'RGT':
                 step = int((preview_width - zoom_prev_width)/num_steps)
                 if(zoom_pos_x + step + zoom_prev_width <= preview_width):
                     zoom_pos_x += step
-                    roi_changed = True
                     print('move roi RIGHT +'+str(step)+'px')
                 
-            # draw overlay
-            img = Image.open(os.path.join(os.path.dirname(sys.argv[0]),'roi_4_3.png')).convert('RGBA')
-            preview_overlay(camera, (zoom_prev_width,zoom_prev_height), img, (zoom_pos_x,zoom_pos_y))
-            
-            #calculate zoom position relative to upper left corner
-            factor_left = zoom_pos_x / preview_width
-            factor_down = zoom_pos_y / preview_height
+            # draw overlay, the image is only loaded once
+            if o is None:
+                o = Image.open(os.path.join(os.path.dirname(sys.argv[0]),'roi_4_3.png')).convert('RGBA')
+            preview_overlay(camera, (zoom_prev_width,zoom_prev_height), o, (zoom_pos_x,zoom_pos_y))
             
             #some debugging output
-            print('preview: '+str(camera.preview.window))
-            print('sensor: '+str(sensor_width)+'x'+str(sensor_height))
-            print('recording: '+str(camera.resolution))
-            print('recording_index: '+str(recording_index))
-            print('recording_index min: '+str(recording_index_min))
-            print('factors: '+str(factor_width)+'x'+str(factor_height))
+            print('sensor mode: '+str(sensor_mode)+' ('+str(geometry['sensor'][0])+'x'+str(geometry['sensor'][1])+')')
+            print('recording: '+str(steps[sensor_mode][step_index])+', padded '+str(geometry['padded']))
+            print('factors: '+str(geometry['factors']))
             print('zoom prev: '+str(zoom_prev_width)+'x'+str(zoom_prev_height))
             print('zoom position: '+str((zoom_pos_x,zoom_pos_y)))
-            print('zoom rel pos: '+str((factor_left,factor_down)))
-            print("sensor mode: "+str(camera.sensor_mode))
-            print("framerate: "+str(camera.framerate))
         else:
             print('No region of interest')
-            camera.zoom = (0,0,1.0,1.0)
             remove_overlays(camera)
                 
-        if event == "Exit" or event == sg.WIN_CLOSED:
-            break
-                
     '''
-    Finally set the camera zoom
+    Finally apply the staged sensor mode, resolution and zoom, closing the window discards them
     ''' 
-    camera.zoom = (factor_left, factor_down, factor_width, factor_height)
     window.close()
+    remove_overlays(camera)
+    if event == sg.WIN_CLOSED:
+        print('roi discarded')
+        return camera
+    
+    if values['roi'] is True:
+        # the zoom factors belong to the selected resolution
+        resolution = steps[sensor_mode][step_index]
+        factor_width, factor_height = table[(sensor_mode, resolution)]['factors']
+        zoom = (zoom_pos_x / preview_width, zoom_pos_y / preview_height, factor_width, factor_height)
+    else:
+        zoom = (0,0,1.0,1.0)
+    configure_camera(camera, sensor_mode, resolution)
+    camera.zoom = zoom
+    print('roi applied: sensor mode '+str(camera.sensor_mode)+', resolution '+str(camera.resolution)+', zoom '+str(zoom))
     return camera
     
 def settings_window(parameters, camera):
@@ -374,6 +475,10 @@ def settings_window(parameters, camera):
         sg.Checkbox('', size=(int(10), 1), enable_events=True, default=(camera.color_effects==(128,128)), key='greyscale', pad=(0,p.pad_y))
         ],
         [
+        sg.Text('Compress raw:', font=("Helvetica", p.font_size, "bold"), pad=(0,p.pad_y), tooltip='Store YUV recordings losslessly compressed (.abr)'),
+        sg.Checkbox('', size=(int(10), 1), enable_events=True, default=p.compress_raw, key='compress_raw', pad=(0,p.pad_y))
+        ],
+        [
         sg.Button('Defaults', size=(10, 1), font='Helvetica 12', pad=(0,p.pad_y)),
         sg.Button('Exit', size=(10, 1), font='Helvetica 12', pad=(p.pad_x,p.pad_y)),
         ]
@@ -430,12 +535,14 @@ def settings_window(parameters, camera):
                 window.FindElement('saturation_slider').Update(Parameters.default_saturation)    
                 window.FindElement('sharpness_slider').Update(Parameters.default_sharpness)       
                 window.FindElement('greyscale').Update(False)
+                window.FindElement('compress_raw').Update(False)
                 window.FindElement('iso_slider').Update(Parameters.default_iso)
                 values['brightness_slider'] = Parameters.default_brightness
                 values['contrast_slider'] = Parameters.default_contrast
                 values['saturation_slider'] = Parameters.default_saturation
                 values['sharpness_slider'] = Parameters.default_sharpness
                 values['greyscale'] = False
+                values['compress_raw'] = False
     
         # change the camera settings for the preview
         camera.brightness = int(values['brightness_slider'])  # brightness     min: 0   , max: 255 , increment:1
@@ -457,10 +564,277 @@ def settings_window(parameters, camera):
             currentColorEffects = None
                 
         camera.color_effects = currentColorEffects
+        
+        # raw recordings in the compressed container
+        p.compress_raw = values['compress_raw']
                     
     return camera
     window.close()
 
+def calibration_window(parameters, camera, folder):
+    '''
+    This function offers a sub-window to record dark, flat and bias series and to build master frames from them
+    
+    The series are recorded with the current gain and sensor mode (at the full resolution of the sensor mode)
+    and combined while they are recorded, so only a few frames are held in memory. Exposure time and gain
+    are locked for the series (the exposure of the light captures, the shortest one for bias) and stored
+    with the master, so find_master() can match it to the captures.
+    
+    Parameters
+    ----------
+    parameters : Class
+                 A class of the parameters used within the program
+    
+    camera     : picamera.camera.PiCamera
+                 The picamera camera object
+    
+    folder     : str
+                 The folder the masters are stored in
+    
+    Returns
+    -------
+    camera     : picamera.camera.PiCamera
+                 The picamera camera object
+    '''
+    import numpy as np
+    import calibration
+    
+    # assign the parameters to name p for ease of use
+    p=parameters
+    
+    cal_controls = [
+        [
+        sg.Text('Type', size=(6,1), font=('Helvetica', 12), pad=(0,p.pad_y)),
+        sg.Combo(calibration.KINDS, default_value='dark', font=('Helvetica', p.font_size), readonly=True, key='cal_kind'),
+        ],
+        [
+        sg.Text('Frames', size=(6,1), font=('Helvetica', 12), pad=(0,p.pad_y)),
+        sg.Spin([i for i in range(3, 1000)], initial_value=p.default_cal_frames, font=('Helvetica', p.font_size), key='cal_frames', pad=(0,p.pad_y)),
+        ],
+        [
+        sg.Text('Method', size=(6,1), font=('Helvetica', 12), pad=(0,p.pad_y)),
+        sg.Combo(calibration.METHODS, default_value='sigma', font=('Helvetica', p.font_size), readonly=True, key='cal_method'),
+        ],
+    ]
+    
+    cal_buttons = [
+        [
+        sg.Button('Record', size=(10, 1), font='Helvetica 12', pad=(p.pad_x,p.pad_y)),
+        sg.Button('Exit', size=(10, 1), font='Helvetica 12', pad=(p.pad_x,p.pad_y)),
+        ],
+        [
+        sg.Text('Idle', size=(22,2), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='cal_status'),
+        ],
+    ]
+    
+    layout = [
+        [
+        sg.Column(cal_controls),
+        sg.VSeperator(),
+        sg.Column(cal_buttons),
+        ],
+    ]
+    
+    window = sg.Window("Calibration", layout, modal=False, location=(0,camera.preview.window[3]))
+    
+    while True:
+        event, values = window.read()
+        
+        if event == "Exit" or event == sg.WIN_CLOSED:
+            break
+        
+        if event == 'Record':
+            kind = values['cal_kind']
+            frames = int(values['cal_frames'])
+            method = values['cal_method']
+            
+            # remember the user settings, the series is taken over the full field of the sensor mode
+            resolution = camera.resolution
+            zoom = camera.zoom
+            shutter = camera.shutter_speed
+            exposure_mode = camera.exposure_mode
+            # the exposure of the light captures, the one fixed by the user or the current automatic one
+            light_exposure = shutter or camera.exposure_speed
+            sensor_mode = camera.sensor_mode
+            try:
+                if(sensor_mode != 0):
+                    camera.resolution = p.sensorModes[1][sensor_mode]
+                else:
+                    camera.resolution = (4056,3040)
+                camera.zoom = (0,0,1.0,1.0)
+                
+                # fix exposure time and gain for the whole series, otherwise the automatic exposure
+                # drives both up as soon as the lens is capped for the darks
+                if kind == 'bias':
+                    camera.shutter_speed = 100 # shortest possible exposure
+                else:
+                    camera.shutter_speed = light_exposure
+                window['cal_status'].update('{}: settling...'.format(kind))
+                window.refresh()
+                sleep(2) # let the gains settle at the current iso
+                camera.exposure_mode = 'off'
+                width, height = camera.resolution
+                gain = float(camera.analog_gain * camera.digital_gain)
+                exposure = camera.exposure_speed
+                print('{}: gain {:.2f}, exposure {}us'.format(kind, gain, exposure))
+                
+                # flats are corrected by a matching master bias if there is one
+                bias = None
+                if kind == 'flat':
+                    bias_file = calibration.find_master(folder, 'bias', sensor_mode, (width, height), gain)
+                    if bias_file is not None:
+                        bias = np.load(bias_file)
+                
+                builder = calibration.MasterBuilder((height, width), method, bias=bias)
+                writer = calibration.CalibrationWriter(camera.resolution, builder, frames)
+                camera.start_recording(writer, format='yuv')
+                try:
+                    while not writer.done:
+                        camera.wait_recording(0.5)
+                        window['cal_status'].update('{}: {}/{} frames'.format(kind, builder.frames, frames))
+                        window.refresh()
+                finally:
+                    camera.stop_recording()
+                
+                filename = calibration.save_master(folder, kind, builder.result(), sensor_mode, (width, height), gain,
+                                                   exposure, calibration.temperature(), builder.frames, method)
+                print('master saved to ' + filename)
+                window['cal_status'].update('saved ' + os.path.basename(filename))
+            finally:
+                # restore the user settings
+                camera.exposure_mode = exposure_mode
+                camera.shutter_speed = shutter
+                camera.resolution = resolution
+                camera.zoom = zoom
+    
+    window.close()
+    return camera
+
+def timelapse_window(parameters, camera, folder):
+    '''
+    This function offers a sub-window to capture a frame every few seconds from the video port
+    
+    The sequence runs in a background thread, so the window stays responsive and the sequence can be stopped.
+    
+    Parameters
+    ----------
+    parameters : Class
+                 A class of the parameters used within the program
+    
+    camera     : picamera.camera.PiCamera
+                 The picamera camera object
+    
+    folder     : str
+                 The folder the sequences are stored in
+    
+    Returns
+    -------
+    camera     : picamera.camera.PiCamera
+                 The picamera camera object
+    '''
+    # assign the parameters to name p for ease of use
+    p=parameters
+    
+    interval_controls = [
+        [
+        sg.Text('Interval / s', size=(10,1), font=('Helvetica', 12), pad=(0,p.pad_y)),
+        sg.Spin([i for i in range(1, 3600)], initial_value=p.default_interval, font=('Helvetica', p.font_size), key='interval', pad=(0,p.pad_y)),
+        ],
+        [
+        sg.Text('Frames', size=(10,1), font=('Helvetica', 12), pad=(0,p.pad_y)),
+        sg.Spin([i for i in range(1, 100000)], initial_value=p.default_interval_frames, font=('Helvetica', p.font_size), key='interval_frames', pad=(0,p.pad_y)),
+        ],
+    ]
+    
+    interval_buttons = [
+        [
+        sg.Button('Start', size=(10, 1), font='Helvetica 12', pad=(p.pad_x,p.pad_y)),
+        sg.Button('Stop', size=(10, 1), font='Helvetica 12', pad=(p.pad_x,p.pad_y)),
+        ],
+        [
+        sg.Button('Exit', size=(10, 1), font='Helvetica 12', pad=(p.pad_x,p.pad_y)),
+        ],
+        [
+        sg.Text('Idle', size=(30,2), font=('Helvetica', 12), pad=(p.pad_x,p.pad_y), key='interval_status'),
+        ],
+    ]
+    
+    layout = [
+        [
+        sg.Column(interval_controls),
+        sg.VSeperator(),
+        sg.Column(interval_buttons),
+        ],
+    ]
+    
+    window = sg.Window("Time-lapse", layout, modal=False, location=(0,camera.preview.window[3]))
+    sequence = None
+    thread = None
+    
+    while True:
+        event, values = window.read(timeout=500)
+        
+        if thread is not None:
+            if thread.is_alive():
+                window['interval_status'].update('{} frames captured'.format(sequence.captured))
+            else:
+                thread = None
+                print('time-lapse: ' + sequence.report())
+                window['interval_status'].update(sequence.report())
+        
+        if event == 'Start' and thread is None:
+            sequence_folder = "{}/Timelapse_{}".format(folder, datetime.now().strftime("%d_%m_%Y_%H_%M_%S"))
+            os.mkdir(sequence_folder)
+            import timelapse
+            sequence = timelapse.IntervalCapture(camera.resolution, p.interval_buffers)
+            thread = threading.Thread(target=sequence.run, args=(camera, sequence_folder, 'Frame', float(values['interval']), int(values['interval_frames'])))
+            thread.start()
+        
+        if event == 'Stop' and thread is not None:
+            sequence.stop.set()
+        
+        if event == "Exit" or event == sg.WIN_CLOSED:
+            if thread is not None:
+                sequence.stop.set()
+                thread.join()
+                print('time-lapse: ' + sequence.report())
+            break
+    
+    window.close()
+    return camera
+
+def wait_recording(camera, duration, jobs, writer=None):
+    '''
+    Waits for the end of a recording while keeping the post-capture jobs out of the way
+    
+    The jobs are throttled during the recording and paused completely whenever the writer falls behind.
+    
+    Parameters
+    ----------
+    camera   : picamera.camera.PiCamera
+               The picamera camera object
+    
+    duration : float
+               Recording time in seconds
+    
+    jobs     : jobqueue.JobQueue
+               The queue of post-capture jobs
+    
+    writer   : rawwriter.RawWriter
+               The custom output of the recording, if any
+    
+    Returns
+    -------
+    None
+    '''
+    end = time.monotonic() + duration
+    while True:
+        jobs.monitor(True, writer is not None and writer.behind)
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        camera.wait_recording(min(remaining, 0.5))
+
 def create_window(layout):
     '''
     This is the function that builds the GUI window using a supplied layout
@@ -553,6 +927,8 @@ def preview_overlay(camera=None, resolution=None, overlay=None, pos=(0,0)):
     -------
     None
     '''
+    from PIL import Image
+    
     # remove all overlays
     remove_overlays(camera)
     
@@ -567,84 +943,141 @@ def preview_overlay(camera=None, resolution=None, overlay=None, pos=(0,0)):
     overlay.alpha = 128
     overlay.layer = 3
 
-def folder_file_selecter():
+def folder_file_selecter(db, starting_path=None):
     '''
-    This function offers a popup menu allowing for multiple images to be selected
+    This function offers a popup menu allowing for multiple captures to be selected
     
-    It views a file and file tree
-    
-    Note, if scanning a large folder then tkinter will eventually complain about too many bitmaps.
-    
-    This can be fixed by reusing the images within PySimpleGUI (TODO: implement if needed at some point)
+    It views a folder and file tree which is filled from the capture catalog.
+    Only the selected folder is listed at first, sub folders are loaded when they are opened.
+    This keeps opening a card with thousands of captures instant and reuses one bitmap per icon,
+    so tkinter does not run out of bitmaps on large folders.
     
     Parameters
     ----------
+    db            : sqlite3.Connection
+                    The open capture catalog
+    
+    starting_path : str
+                    The folder to display, the user is asked for it if not given
     
     Returns
     -------
-    values :
-    
+    values : List[str]
+             Paths of the selected captures and folders (sequence folders are shown as single captures)
     '''
     # base64 versions of images of a folder and a file. PNG files (may not work with PySimpleGUI27, swap with GIFs)
     folder_icon = b'iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAACXBIWXMAAAsSAAALEgHS3X78AAABnUlEQVQ4y8WSv2rUQRSFv7vZgJFFsQg2EkWb4AvEJ8hqKVilSmFn3iNvIAp21oIW9haihBRKiqwElMVsIJjNrprsOr/5dyzml3UhEQIWHhjmcpn7zblw4B9lJ8Xag9mlmQb3AJzX3tOX8Tngzg349q7t5xcfzpKGhOFHnjx+9qLTzW8wsmFTL2Gzk7Y2O/k9kCbtwUZbV+Zvo8Md3PALrjoiqsKSR9ljpAJpwOsNtlfXfRvoNU8Arr/NsVo0ry5z4dZN5hoGqEzYDChBOoKwS/vSq0XW3y5NAI/uN1cvLqzQur4MCpBGEEd1PQDfQ74HYR+LfeQOAOYAmgAmbly+dgfid5CHPIKqC74L8RDyGPIYy7+QQjFWa7ICsQ8SpB/IfcJSDVMAJUwJkYDMNOEPIBxA/gnuMyYPijXAI3lMse7FGnIKsIuqrxgRSeXOoYZUCI8pIKW/OHA7kD2YYcpAKgM5ABXk4qSsdJaDOMCsgTIYAlL5TQFTyUIZDmev0N/bnwqnylEBQS45UKnHx/lUlFvA3fo+jwR8ALb47/oNma38cuqiJ9AAAAAASUVORK5CYII='
     file_icon = b'iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAACXBIWXMAAAsSAAALEgHS3X78AAABU0lEQVQ4y52TzStEURiHn/ecc6XG54JSdlMkNhYWsiILS0lsJaUsLW2Mv8CfIDtr2VtbY4GUEvmIZnKbZsY977Uwt2HcyW1+dTZvt6fn9557BGB+aaNQKBR2ifkbgWR+cX13ubO1svz++niVTA1ArDHDg91UahHFsMxbKWycYsjze4muTsP64vT43v7hSf/A0FgdjQPQWAmco68nB+T+SFSqNUQgcIbN1bn8Z3RwvL22MAvcu8TACFgrpMVZ4aUYcn77BMDkxGgemAGOHIBXxRjBWZMKoCPA2h6qEUSRR2MF6GxUUMUaIUgBCNTnAcm3H2G5YQfgvccYIXAtDH7FoKq/AaqKlbrBj2trFVXfBPAea4SOIIsBeN9kkCwxsNkAqRWy7+B7Z00G3xVc2wZeMSI4S7sVYkSk5Z/4PyBWROqvox3A28PN2cjUwinQC9QyckKALxj4kv2auK0xAAAAAElFTkSuQmCC'
 
-    # create popup which lets user select folder with images
-    starting_path = sg.popup_get_folder('Select Folder to display')
+    # create popup which lets user select folder with captures
+    if starting_path is None:
+        starting_path = sg.popup_get_folder('Select Folder to display', default_path=Parameters.default_save_folder_vid)
 
     if not starting_path:
-        sys.exit(0)
+        return []
 
-    treedata = sg.TreeData()
+    layout = [[sg.Text('Select captures')],
+              [sg.Tree(data=sg.TreeData(),
+                       headings=['Size / MB', 'Resolution', 'Duration / s', 'Frames', 'Gain', 'Score'],
+                       auto_size_columns=True,
+                       select_mode=sg.TABLE_SELECT_MODE_EXTENDED,
+                       num_rows=20,
+                       col0_width=40,
+                       key='-TREE-',
+                       show_expanded=False,
+                       enable_events=True,
+                       ),],
+              [sg.Button('Ok'), sg.Button('Cancel')]]
 
-    def add_files_in_folder(parent, dirname):
+    window = sg.Window('Capture tree', layout, resizable=True, finalize=True)
+    tree = window['-TREE-']
+    tree.expand(True, True) # resize with the window (Full support for Tree element being released in 4.44.0)
+    tree.bind('<<TreeviewOpen>>', 'OPEN')
+    
+    # one bitmap per icon for the whole tree
+    icons = {'folder': sg.tk.PhotoImage(data=folder_icon), 'file': sg.tk.PhotoImage(data=file_icon)}
+    loaded = set()
+    
+    def insert_node(parent, key, text, values, icon):
+        '''
+        Inserts a single node directly into the treeview widget and registers its key with the Tree element
+        
+        Parameters
+        ----------
+        parent : str
+                 Key of the parent node, '' for the top level
+        
+        key    : str
+                 Key of the new node
+        
+        text   : str
+                 Displayed name
+        
+        values : list
+                 Values of the heading columns
+        
+        icon   : str
+                 'folder' or 'file'
+        
+        Returns
+        -------
+        None
         '''
-        This builds the file tree by looping through the selected folder
+        id = tree.Widget.insert(tree.KeyToID[parent], 'end', text=text, values=values, image=icons[icon])
+        tree.IdToKey[id] = key
+        tree.KeyToID[key] = id
+    
+    def load_folder(parent, dirname):
+        '''
+        Adds the content of one folder to the tree, sub folders get a placeholder so they can be opened
         
         Parameters
         ----------
-        parent  : 
+        parent  : str
+                  Key of the node to fill
         
         dirname : str
-                  The directory where the images are located 
+                  The folder to load from the catalog
+        
         Returns
         -------
         None
         '''
-        files = os.listdir(dirname)
-        for f in files:
-            fullname = os.path.join(dirname, f)
-            if os.path.isdir(fullname): # if it's a folder, add folder and recurse
-                treedata.Insert(parent, fullname, f, values=[], icon=folder_icon)
-                add_files_in_folder(fullname, fullname)
-            else:
-                treedata.Insert(parent, fullname, f, values=[os.stat(fullname).st_size], icon=file_icon)
-
-    add_files_in_folder('', starting_path)
-
-    layout = [[sg.Text('Select images to stack')],
-              [sg.Tree(data=treedata,
-                       headings=['Size', ],
-                       auto_size_columns=True,
-                       select_mode=sg.TABLE_SELECT_MODE_EXTENDED,
-                       num_rows=20,
-                       col0_width=40,
-                       key='-TREE-',
-                       show_expanded=False,
-                       enable_events=True,
-                       ),],
-              [sg.Button('Ok'), sg.Button('Cancel')]]
-
-    window = sg.Window('Image tree', layout, resizable=True, finalize=True)
-    window['-TREE-'].expand(True, True) # resize with the window (Full support for Tree element being released in 4.44.0)
+        loaded.add(dirname)
+        folders, captures = catalog.list_folder(db, dirname)
+        for path in folders:
+            insert_node(parent, path, os.path.basename(path), [], 'folder')
+            insert_node(path, path + os.sep, '...', [], 'file') # placeholder, replaced when the folder is opened
+        for path, name, fmt, width, height, duration, size, gain, frames, score in captures:
+            values = [round(size / 1e6, 1),
+                      '{}x{}'.format(width, height) if width else '',
+                      duration or '',
+                      frames or '',
+                      round(gain, 2) if gain else '',
+                      round(score, 2) if score is not None else '']
+            insert_node(parent, path, name, values, 'file')
+    
+    load_folder('', starting_path)
 
     while True: # Event Loop
         event, images = window.read()
         if event in (sg.WIN_CLOSED, 'Cancel', 'Ok'):
             break
         
+        # lazy loading of opened sub folders
+        if event == '-TREE-OPEN':
+            dirname = tree.IdToKey.get(tree.Widget.focus())
+            if dirname and dirname not in loaded:
+                placeholder = tree.KeyToID.pop(dirname + os.sep)
+                tree.IdToKey.pop(placeholder)
+                tree.Widget.delete(placeholder)
+                load_folder(dirname, dirname)
+        
     window.close()
-    return images['-TREE-']
+    if images is None:
+        return []
+    # placeholders of folders which were never opened are no captures
+    return [key for key in images['-TREE-'] if not key.endswith(os.sep)]
 
 def set_date_time():
     '''
@@ -666,7 +1099,65 @@ def set_date_time():
 
     # run the command
     os.system('sudo date -s "{}"'.format(date_time))
-            
+
+def open_camera(resolution, sensor_mode=0, startup=False):
+    '''
+    Opens the camera and starts the live preview
+
+    picamera is imported here, so the import can run in the background together with the
+    camera initialisation while the GUI is built.
+
+    Parameters
+    ----------
+    resolution  : tuple
+                  Resolution of the camera
+
+    sensor_mode : int
+                  Sensor mode of the camera, 0 for automatic selection
+
+    startup     : bool
+                  Record the stages for startup_report()
+
+    Returns
+    -------
+    camera      : picamera.camera.PiCamera
+                  The picamera camera object
+    '''
+    import picamera
+    if startup:
+        startup_mark('import picamera')
+    camera = picamera.PiCamera(resolution=resolution, sensor_mode=sensor_mode)
+    if startup:
+        startup_mark('open camera')
+    width, height = Parameters.default_preview_size
+    camera.start_preview(resolution=(width,height), fullscreen=False, window=(0,0,width,height))
+    if startup:
+        startup_mark('first preview')
+    return camera
+
+def startup_report():
+    '''
+    Prints the startup timing breakdown
+
+    Every stage is listed with the time since launch and its own duration (time since the previous
+    stage of the same thread). The GUI and the camera are started in parallel, so the durations of
+    the two threads overlap. The lines are parsed by the startup benchmark of benchmark.py.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    # the first mark ('imports') is recorded by the main thread, all other threads are started after it
+    imported = STARTUP_MARKS[0][1]
+    previous = {STARTUP_MARKS[0][2]: 0.0}
+    for stage, seconds, thread in sorted(STARTUP_MARKS, key=lambda mark: mark[1]):
+        print('startup: {:<16} {:6.2f} s  (+{:.2f} s, {})'.format(stage, seconds, seconds - previous.get(thread, imported), thread))
+        previous[thread] = seconds
+
 def main():
     '''
     This is the main function that controls the entire program. It has all been wrapped inside a function for easy exit of the various options using a function return
@@ -682,8 +1173,19 @@ def main():
     None
     '''   
      
+    # init recording resolution
+    recordingResolution = (1920,1088)
+    
+    # open the camera and start the preview in the background while the GUI is built
+    camera_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='camera')
+    camera_future = camera_thread.submit(open_camera, recordingResolution, startup=True)
+    camera_thread.shutdown(wait=False)
+    
     # create the GUI window using create_window() which takes the layout function as its argument
-    window = create_window(create_layout(Parameters()))
+    layout = create_layout(Parameters())
+    startup_mark('layout')
+    window = create_window(layout)
+    startup_mark('window')
     
     # set the default save folder for the images
     cam_folder_save = Parameters.default_save_folder
@@ -691,12 +1193,13 @@ def main():
     # set the default save folder for the videos
     vid_folder_save = Parameters.default_save_folder_vid
     
-    # init recording resolution
-    recordingResolution = (1920,1088)
-    
     # if videos folder does not exist, create it
     if not os.path.isdir(vid_folder_save):
         os.mkdir(vid_folder_save)
+    
+    # open the capture catalog, every finished recording is added to it
+    captures = catalog.open_catalog(os.path.join(vid_folder_save, Parameters.catalog_name))
+    startup_mark('catalog')
         
     # list of resolutions to view the live preview
     resolution_list = ["320 x 240", "640 x 480", "1280 x 720", "1920 x 1080", "2560 x 1440"]
@@ -704,11 +1207,26 @@ def main():
     # extract out the width and height from the resolution individually
     width, height = [int(num) for num in (resolution_list[0]).split() if num.isdigit()]
     
-    # start the preview
-    #with picamera.PiCamera(resolution=(3280,2464)) as camera:
-    with picamera.PiCamera(resolution=recordingResolution) as camera:
-        camera.start_preview(resolution=(350,300), fullscreen=False, window=(0,0,350,300))
-        time.sleep(3)
+    # wait for the camera, the preview was started by open_camera()
+    with camera_future.result() as camera:
+        # let the camera settle, most of the warm-up has already passed while the window was built
+        preview_started = STARTUP_START + [mark[1] for mark in STARTUP_MARKS if mark[0] == 'first preview'][0]
+        time.sleep(max(0, Parameters.camera_warmup - (time.monotonic() - preview_started)))
+        startup_mark('camera ready')
+        
+        # start the workers of the post-capture jobs, queued jobs of the last session are resumed
+        # (they are started by a fork server, not forked from this multithreaded process)
+        jobs = jobqueue.JobQueue(os.path.join(vid_folder_save, Parameters.jobs_name), Parameters.job_workers, Parameters.job_cpus)
+        startup_mark('job queue')
+        startup_report()
+        
+        # measure the startup only, used by the startup benchmark of benchmark.py
+        if '--startup-bench' in sys.argv:
+            camera.stop_preview()
+            window.close()
+            captures.close()
+            jobs.close()
+            return
         
         # set a counter to be able to iterate through the resolution options
         res_counter = 0
@@ -740,6 +1258,10 @@ def main():
             # change the default save location if selected from the Menu
             if event == 'Save Location':      
                 cam_folder_save = sg.PopupGetFolder('save_folder', initial_folder='{}'.format(Parameters.default_save_folder), no_window=True, keep_on_top=True)            
+            
+            # browse the recorded captures
+            if event == 'Browse Captures':
+                folder_file_selecter(captures, vid_folder_save)
                     
             # closing the program by pressing exit
             if event == sg.WIN_CLOSED or event == 'Exit':
@@ -749,6 +1271,10 @@ def main():
                 camera.close()
                 # close the GUI window
                 window.close()
+                # close the capture catalog
+                captures.close()
+                # stop the post-capture jobs, unfinished ones are resumed on the next launch
+                jobs.close()
                 
                 return
                 
@@ -793,6 +1319,7 @@ def main():
                 time.sleep(3)
             
             if event == "Crosshair On":
+                from PIL import Image
                 img = Image.open(os.path.join(os.path.dirname(sys.argv[0]),'crosshair.png')).convert('RGBA')
                
                 preview_overlay(camera, (width,height), img)
@@ -804,6 +1331,95 @@ def main():
             if event == 'ROI':
                 camera = roi_window(Parameters, camera)
             
+            # sweep a mosaic of ROI panels over the sensor
+            if event == 'Mosaic':
+                zoom = camera.zoom
+                if zoom[2] >= 1.0 and zoom[3] >= 1.0:
+                    sg.popup('Define a region of interest first, it sets the panel size of the mosaic')
+                else:
+                    panel_time = sg.popup_get_text('Recording time per panel / s', 'Mosaic', default_text=str(Parameters.default_panel_time))
+                    if panel_time and panel_time.isdigit():
+                        window.find_element('output').Update('Working...')
+                        window.Refresh()
+                        
+                        # same limits as for H264 recordings, the user settings are restored afterwards
+                        framerate = camera.framerate
+                        resolution = camera.resolution
+                        if(camera.framerate > 30):
+                            camera.framerate = 30
+                        if(camera.resolution[0]/16*camera.resolution[1]/16 > 8192):
+                            camera.resolution = (1920,1088)
+                        framesize = camera.resolution
+                        if(camera.sensor_mode != 0):
+                            sensor_resolution = Parameters.sensorModes[1][camera.sensor_mode]
+                        else:
+                            sensor_resolution = (4056,3040)
+                        
+                        import mosaic
+                        panels = mosaic.mosaic_grid(zoom[2:], Parameters.mosaic_overlap)
+                        video_save_file_name = "{}/Video_{}x{}_{}_{}s_panel{{row:02d}}{{col:02d}}.h264".format(vid_folder_save, framesize[0], framesize[1], current_day_time, panel_time)
+                        manifest = "{}/Mosaic_{}.json".format(vid_folder_save, current_day_time)
+                        jobs.monitor(True)
+                        try:
+                            sweep_time = mosaic.record_mosaic(camera, panels, video_save_file_name, int(panel_time), sensor_resolution, manifest,
+                                                               wait=lambda duration: wait_recording(camera, duration, jobs))
+                        finally:
+                            # stopped workers would block the exit
+                            jobs.monitor(False)
+                            #reset framerate, recording resolution and roi to user choice
+                            camera.resolution = resolution
+                            camera.framerate = framerate
+                            camera.zoom = zoom
+                        print('mosaic: {} panels recorded in {:.1f}s, layout in {}'.format(len(panels), sweep_time, manifest))
+                        for panel in panels:
+                            catalog.add_capture(captures, panel['file'], gain=float(camera.analog_gain * camera.digital_gain))
+                        
+                        window.find_element('output').Update('Idle')
+                        window.Refresh()
+            
+            # capture a frame every few seconds
+            if event == 'Time-lapse':
+                camera = timelapse_window(Parameters, camera, vid_folder_save)
+            
+            # capture a burst of raw bayer frames as DNG
+            if event == 'Raw Burst':
+                burst_frames = sg.popup_get_text('Number of raw frames', 'Raw Burst', default_text=str(Parameters.default_burst_frames))
+                if burst_frames and burst_frames.isdigit():
+                    window.find_element('output').Update('Working...')
+                    window.Refresh()
+                    
+                    import rawburst
+                    
+                    # the raw data always covers the full field of the sensor mode
+                    resolution = camera.resolution
+                    zoom = camera.zoom
+                    if(camera.sensor_mode != 0):
+                        raw_resolution = Parameters.sensorModes[1][camera.sensor_mode]
+                    else:
+                        raw_resolution = rawburst.FULL_RESOLUTION
+                    camera.resolution = raw_resolution
+                    camera.zoom = (0,0,1.0,1.0)
+                    
+                    burst_folder = "{}/Raw_{}x{}_{}".format(vid_folder_save, raw_resolution[0], raw_resolution[1], current_day_time)
+                    os.mkdir(burst_folder)
+                    burst = rawburst.BurstCapture(raw_resolution, Parameters.raw_buffers, Parameters.raw_workers)
+                    jobs.monitor(True)
+                    try:
+                        fps = burst.capture(camera, burst_folder, 'Raw', int(burst_frames), jobs)
+                    finally:
+                        burst.close()
+                        jobs.monitor(False)
+                    print('sensor mode {}: {:.2f} raw frames/s sustained'.format(camera.sensor_mode, fps))
+                    
+                    camera.resolution = resolution
+                    camera.zoom = zoom
+                    window.find_element('output').Update('Idle')
+                    window.Refresh()
+            
+            # record calibration series
+            if event == 'Calibration':
+                camera = calibration_window(Parameters, camera, os.path.join(vid_folder_save, Parameters.calibration_folder))
+            
             # record video
             if event == 'H264':
                 # update the activity notification
@@ -845,8 +1461,13 @@ def main():
                 # start the video recording.
                 # we use h264 format 
                 camera.start_recording(video_save_file_name, format='h264', quality=10, bitrate=0)
-                camera.wait_recording(cam_vid_time)
-                camera.stop_recording()
+                try:
+                    wait_recording(camera, cam_vid_time, jobs)
+                    camera.stop_recording()
+                finally:
+                    # stopped workers would block the exit
+                    jobs.monitor(False)
+                catalog.add_capture(captures, video_save_file_name, duration=cam_vid_time, gain=float(camera.analog_gain * camera.digital_gain))
                 #reset recording resolution to user choice in case it was adapted automatically for the last recording
                 camera.resolution=recordingResolution
                     
@@ -857,18 +1478,20 @@ def main():
             # record uncompressed raw video
             if event == 'YUV':
                 # set the resolution for the video capture
-                # resolution has to match the sensor mode, so no cropping is possible
-                # force resolution to sensor mode
-                if(camera.sensor_mode != 0):
-                    recordingResolution = resolution = _pad(Parameters.sensorModes[1][camera.sensor_mode])
+                # the camera records the full field of the sensor mode, the region of interest
+                # chosen in roi_window() is cropped in software by the raw writer
+                roi = camera.zoom
+                greyscale = (camera.color_effects == (128,128))
+                sensor_mode = camera.sensor_mode
+                if(sensor_mode != 0):
+                    recordingResolution = Parameters.sensorModes[1][sensor_mode]
                 else:
                     recordingResolution = (4056,3040)
                 
                 camera.stop_preview()
                 camera.close()
                 sleep(1)
-                camera = picamera.PiCamera(resolution=recordingResolution)
-                camera.start_preview(resolution=(350,300), fullscreen=False, window=(0,0,350,300)) 
+                camera = open_camera(recordingResolution, sensor_mode)
                 
                 # update the activity notification
                 window.find_element('output').Update('Working...')
@@ -882,27 +1505,68 @@ def main():
                 camera.image_effect = 'none'
                 camera.hflip = False
                 camera.vflip = False
+                if greyscale:
+                    camera.color_effects = (128,128)
                     
                 window.find_element('-RECRES-').Update(camera.resolution)
                 window.Refresh()
-                print('\nResolution has to match the sensor mode, so no cropping is possible. Enforcing highest possible resolution to match sensor mode.')
-               
-                framesize = _pad(camera.resolution)
+                print('\nRecording full sensor mode resolution, cropping to the region of interest in software.')
+                
+                import rawwriter
+                import rawcontainer
+                
+                # crop to the roi, strip the padding and write luma only in grey scale mode
+                crop = rawwriter.roi_crop(roi, camera.resolution)
+                framesize = (crop[2], crop[3])
                 print('framesize: ' + str(framesize))
                 print('sensor mode: ' + str(camera.sensor_mode))
                 
                 # specify the name of the video save file
-                video_save_file_name = "{}/Video_{}x{}_{}_{}s.yuv".format(vid_folder_save, framesize[0], framesize[1], current_day_time, cam_vid_time)
+                if Parameters.compress_raw:
+                    video_format = 'abr'
+                elif greyscale:
+                    video_format = 'gray'
+                else:
+                    video_format = 'yuv'
+                video_save_file_name = "{}/Video_{}x{}_{}_{}s.{}".format(vid_folder_save, framesize[0], framesize[1], current_day_time, cam_vid_time, video_format)
+                if Parameters.compress_raw:
+                    writer = rawcontainer.CompressedWriter(video_save_file_name, camera.resolution, crop, greyscale, workers=Parameters.compress_workers)
+                else:
+                    writer = rawwriter.RawWriter(video_save_file_name, camera.resolution, crop, greyscale)
                 
                 # start the video recording.
                 # we use YUV format 
-                camera.start_recording(video_save_file_name, format='yuv')
-                camera.wait_recording(cam_vid_time)
-                camera.stop_recording()
+                camera.start_recording(writer, format='yuv')
+                
+                # the crop and the settings are kept next to the capture to find and align the calibration masters
+                import calibration
+                rawwriter.write_info(video_save_file_name, camera.resolution, crop, camera.sensor_mode,
+                                     float(camera.analog_gain * camera.digital_gain), camera.exposure_speed, calibration.temperature())
+                
+                try:
+                    wait_recording(camera, cam_vid_time, jobs, writer)
+                finally:
+                    try:
+                        camera.stop_recording()
+                    finally:
+                        # stopped workers would block the exit
+                        jobs.monitor(False)
+                        # flushes the file, a container also gets its index
+                        writer.close()
+                catalog.add_capture(captures, video_save_file_name, duration=cam_vid_time, gain=float(camera.analog_gain * camera.digital_gain), frames=writer.frames)
+                
+                # score the frames and create a thumbnail in the background
+                jobs.add('thumbnail', capture=video_save_file_name, thumbnail=os.path.join(vid_folder_save, Parameters.thumbnail_folder, os.path.basename(video_save_file_name) + '.png'))
+                jobs.add('score', capture=video_save_file_name, catalog_file=os.path.join(vid_folder_save, Parameters.catalog_name))
+                
+                # keep the roi for the preview and the next recordings
+                camera.zoom = roi
                     
                 # reset the activity notification
                 window.find_element('output').Update('Idle')
                 window.Refresh()
                 
 # run the main function
-main()
+# (the worker processes of the job queue and the raw burst import this file again, they must not start the GUI)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+    Name    : benchmark
+
+    Benchmarks for the performance critical parts of AstroBeaver.
+    They run on synthetic data, so they work on the Pi as well as on a laptop without camera.
+
+    Usage
+    -----
+    python3 benchmark.py                   run all benchmarks
+    python3 benchmark.py framequality      run only the named benchmarks
+
+    The startup benchmark launches AstroBeaverVideo.py and needs the camera and a display.
+'''
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+def synthetic_capture(folder, resolution=(1014, 608), frames=200, fmt='gray'):
+    '''
+    Writes a raw capture with a blurred disc and noise, named like a recording of main()
+
+    Parameters
+    ----------
+    folder     : str
+                 Where to put the file
+
+    resolution : tuple
+                 Frame width and height
+
+    frames     : int
+                 Number of frames
+
+    fmt        : str
+                 'gray' or 'yuv'
+
+    Returns
+    -------
+    filename   : str
+                 Path of the capture
+    '''
+    width, height = resolution
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:height, 0:width]
+    disc = ((xx - width / 2) ** 2 + (yy - height / 2) ** 2 < (height / 3) ** 2) * 180.0
+    filename = os.path.join(folder, 'Video_{}x{}_01_01_2023_00_00_00_1s.{}'.format(width, height, fmt))
+    with open(filename, 'wb') as f:
+        for _ in range(frames):
+            frame = np.clip(disc + rng.normal(0, rng.uniform(2, 20), disc.shape), 0, 255).astype(np.uint8)
+            f.write(frame)
+            if fmt == 'yuv':
+                f.write(np.full(width * height // 2, 128, dtype=np.uint8))
+    return filename
+
+def bench_framequality():
+    '''
+    Frame quality ranking throughput in frames/s for one worker and for all cores
+    '''
+    import framequality
+    with tempfile.TemporaryDirectory() as folder:
+        capture = framequality.open_capture(synthetic_capture(folder))
+        results = {}
+        for workers in sorted({1, os.cpu_count()}):
+            start = time.monotonic()
+            framequality.rank(capture, workers)
+            results['{} workers'.format(workers)] = capture['frames'] / (time.monotonic() - start)
+    return results, 'frames/s'
+
+def bench_rawunpack():
+    '''
+    Unpacking of 12 bit packed raw frames in frames/s for the resolution of every sensor mode
+    '''
+    import rawburst
+    results = {}
+    for resolution in (rawburst.FULL_RESOLUTION, (2028, 1520), (2028, 1080), (1332, 990)):
+        stride, size = rawburst.raw_geometry(resolution)
+        data = np.random.default_rng(0).integers(0, 256, size, dtype=np.uint8)
+        image = np.empty((resolution[1], resolution[0]), dtype=np.uint16)
+        frames = 5
+        start = time.monotonic()
+        for _ in range(frames):
+            rawburst.unpack12(data[rawburst.RAW_HEADER:], resolution, stride, out=image)
+        results['{}x{}'.format(*resolution)] = frames / (time.monotonic() - start)
+    return results, 'frames/s'
+
+def bench_startup():
+    '''
+    Startup of the GUI in seconds since launch, per stage (time to first preview and until the program is ready)
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AstroBeaverVideo.py')
+    try:
+        output = subprocess.run([sys.executable, script, '--startup-bench'], capture_output=True, text=True,
+                                timeout=120, check=True).stdout
+    except (subprocess.SubprocessError, OSError) as e:
+        print('startup benchmark skipped, AstroBeaverVideo.py failed: {}'.format(e))
+        return {}, 's'
+    results = {}
+    for stage, seconds in re.findall(r'^startup: (.+?)\s+([\d.]+) s', output, re.MULTILINE):
+        results[stage] = float(seconds)
+    return results, 's'
+
+BENCHMARKS = {
+    'framequality': bench_framequality,
+    'rawunpack': bench_rawunpack,
+    'startup': bench_startup,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the AstroBeaver benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run: {} (default: all)'.format(', '.join(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+
+    for name in args.names or BENCHMARKS:
+        results, unit = BENCHMARKS[name]()
+        for case, value in results.items():
+            print('{:<16} {:<24} {:10.2f} {}'.format(name, case, value, unit))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+'''
+    Name    : calibration
+
+    Dark, flat and bias master frames.
+
+    Calibration series are recorded through the video port like raw YUV captures and fed frame by
+    frame into a MasterBuilder, which never holds more than one small chunk of frames in memory:
+    every chunk is reduced to its mean, median or sigma clipped mean and accumulated into a running
+    per pixel mean. Masters are built from the luma plane only (the chroma planes of the camera's
+    YUV output are not calibrated).
+
+    The masters are stored as .npy files together with an index (masters.json) which records sensor
+    mode, resolution, gain, exposure and temperature, so a matching master can be found for a capture.
+
+    Usage
+    -----
+    python3 calibration.py list /media/.../videos/calibration
+    python3 calibration.py apply Video.gray [--dark dark.npy] [--flat flat.npy] [--offset X Y]
+
+    Without --dark and --flat the matching masters are looked up in the calibration folder next to
+    the capture, and the offset of the region of interest is read from the sidecar of the capture
+    (Video.gray.json, written when recording).
+'''
+
+import argparse
+import json
+import os
+from datetime import datetime
+import numpy as np
+import framequality
+import rawwriter
+
+KINDS = ('dark', 'flat', 'bias')
+METHODS = ('mean', 'median', 'sigma')
+INDEX_NAME = 'masters.json'
+
+# memory for the frames of one chunk, the Pi 3B+ has 1 GB
+CHUNK_BYTES = 64 * 1024 * 1024
+MAX_CHUNK_FRAMES = 16
+
+# memory for the float temporaries of the median and the sigma clipping of one strip of rows
+STRIP_BYTES = 8 * 1024 * 1024
+
+class MasterBuilder:
+    '''
+    Streaming, memory bounded combination of calibration frames
+
+    The frames of a chunk are kept as uint8 luma, the number of frames per chunk is derived from
+    CHUNK_BYTES. A full chunk is reduced in strips of rows, so the float temporaries of the median
+    and the sigma clipping never exceed STRIP_BYTES.
+
+    Parameters
+    ----------
+    shape        : tuple
+                   Height and width of the frames
+
+    method       : str
+                   'mean', 'median' (mean of chunk medians) or 'sigma' (mean of sigma clipped chunks)
+
+    chunk_frames : int
+                   Number of frames held in memory at once, derived from CHUNK_BYTES if not given
+
+    sigma        : float
+                   Clipping threshold in units of the robust standard deviation
+
+    bias         : numpy.ndarray
+                   Master bias subtracted from every frame (for flats), optional
+    '''
+    def __init__(self, shape, method='sigma', chunk_frames=None, sigma=3.0, bias=None):
+        if method not in METHODS:
+            raise ValueError('unknown method {}'.format(method))
+        self.shape = tuple(shape)
+        self.method = method
+        self.sigma = sigma
+        self.bias = bias
+        height, width = self.shape
+        if chunk_frames is None:
+            # at least three frames, otherwise median and clipping are meaningless
+            chunk_frames = min(MAX_CHUNK_FRAMES, max(3, CHUNK_BYTES // (height * width)))
+        self.chunk = np.empty((chunk_frames,) + self.shape, dtype=np.uint8)
+        self.fill = 0
+        self.total = np.zeros(self.shape, dtype=np.float32)
+        # only sigma clipping needs a weight per pixel, otherwise every pixel has the same weight
+        self.weight = np.zeros(self.shape, dtype=np.float32) if method == 'sigma' else 0
+        self.frames = 0
+
+    def add(self, frame):
+        '''
+        Adds a single frame
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+                2D uint8 image of the builder's shape
+
+        Returns
+        -------
+        None
+        '''
+        np.copyto(self.chunk[self.fill], frame, casting='unsafe')
+        self.fill += 1
+        self.frames += 1
+        if self.fill == len(self.chunk):
+            self._reduce()
+
+    def _reduce(self):
+        '''
+        Combines the frames of the current chunk and adds them to the running mean
+        '''
+        n = self.fill
+        height, width = self.shape
+        rows = max(1, STRIP_BYTES // (4 * n * width))
+        for top in range(0, height, rows):
+            strip = slice(top, top + rows)
+            data = self.chunk[:n, strip].astype(np.float32)
+            if self.bias is not None:
+                data -= self.bias[strip]
+            if self.method == 'mean' or n < 3:
+                self.total[strip] += data.sum(axis=0)
+            elif self.method == 'median':
+                self.total[strip] += n * np.median(data, axis=0)
+            else:
+                median = np.median(data, axis=0)
+                deviation = np.abs(data - median)
+                # robust standard deviation from the median absolute deviation
+                limit = self.sigma * np.maximum(1.4826 * np.median(deviation, axis=0), 0.5)
+                keep = deviation <= limit
+                data[~keep] = 0
+                self.total[strip] += data.sum(axis=0)
+                self.weight[strip] += keep.sum(axis=0)
+        if self.method != 'sigma' or n < 3:
+            self.weight += n
+        self.fill = 0
+
+    def result(self):
+        '''
+        Returns the master frame, the builder can not be used any more afterwards
+
+        Returns
+        -------
+        master : numpy.ndarray
+                 float32 image
+        '''
+        if self.fill:
+            self._reduce()
+        if not self.frames:
+            raise ValueError('no frames added')
+        # computed in place, a full resolution float frame is 49 MB
+        self.total /= np.maximum(self.weight, 1, out=self.weight) if self.method == 'sigma' else max(self.weight, 1)
+        return self.total
+
+class CalibrationWriter(rawwriter.RawWriter):
+    '''
+    picamera custom output which feeds the luma plane of every frame into a MasterBuilder
+
+    Parameters
+    ----------
+    resolution : tuple
+                 Resolution of the camera
+
+    builder    : MasterBuilder
+                 Builder for the master frame
+
+    frames     : int
+                 Number of frames to use, later frames are ignored
+    '''
+    def __init__(self, resolution, builder, frames):
+        super().__init__(None, resolution, greyscale=True)
+        self.builder = builder
+        self.wanted = frames
+
+    @property
+    def done(self):
+        return self.builder.frames >= self.wanted
+
+    def write_frame(self, planes):
+        if not self.done:
+            self.builder.add(planes[0])
+
+def temperature():
+    '''
+    Reads the SoC temperature of the Pi, which is used as proxy for the sensor temperature
+    (the HQ camera does not report its own temperature through picamera)
+
+    Returns
+    -------
+    temperature : float or None
+                  Temperature in degree Celsius, None if not available
+    '''
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp') as f:
+            return int(f.read()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+def load_index(folder):
+    '''
+    Reads the list of stored masters
+
+    Returns
+    -------
+    masters : List[dict]
+              One entry per master
+    '''
+    try:
+        with open(os.path.join(folder, INDEX_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+def save_master(folder, kind, master, sensor_mode, resolution, gain, exposure, temperature, frames, method):
+    '''
+    Stores a master frame and adds it to the index
+
+    Parameters
+    ----------
+    folder      : str
+                  The calibration folder
+
+    kind        : str
+                  'dark', 'flat' or 'bias'
+
+    master      : numpy.ndarray
+                  The master frame
+
+    sensor_mode : int
+                  Sensor mode of the camera
+
+    resolution  : tuple
+                  Resolution of the camera
+
+    gain        : float
+                  Total gain (analog * digital)
+
+    exposure    : int
+                  Exposure time in microseconds
+
+    temperature : float
+                  Temperature in degree Celsius, may be None
+
+    frames      : int
+                  Number of combined frames
+
+    method      : str
+                  Combination method of the MasterBuilder
+
+    Returns
+    -------
+    filename    : str
+                  Path of the stored master
+    '''
+    os.makedirs(folder, exist_ok=True)
+    now = datetime.now()
+    name = '{}_mode{}_{}x{}_gain{:.2f}_{}us_{}.npy'.format(kind, sensor_mode, resolution[0], resolution[1],
+                                                         gain, exposure, now.strftime("%d_%m_%Y_%H_%M_%S"))
+    np.save(os.path.join(folder, name), master)
+
+    masters = load_index(folder)
+    masters.append({'file': name, 'kind': kind, 'sensor_mode': sensor_mode, 'resolution': list(resolution),
+                    'gain': gain, 'exposure': exposure, 'temperature': temperature, 'frames': frames,
+                    'method': method, 'date': now.isoformat(timespec='seconds')})
+    with open(os.path.join(folder, INDEX_NAME), 'w') as f:
+        json.dump(masters, f, indent=1)
+    return os.path.join(folder, name)
+
+def find_master(folder, kind, sensor_mode, resolution, gain, exposure=None, temperature=None):
+    '''
+    Finds the best matching master
+
+    Sensor mode and resolution have to match, gain (and for darks exposure) within 10%.
+    Among those the master with the closest temperature, then the newest one, wins.
+
+    Returns
+    -------
+    filename : str or None
+               Path of the master, None if there is no matching one
+    '''
+    def close(a, b):
+        return abs(a - b) <= 0.1 * max(abs(a), abs(b), 1e-9)
+
+    candidates = [m for m in load_index(folder)
+                  if m['kind'] == kind
+                  and m['sensor_mode'] == sensor_mode
+                  and tuple(m['resolution']) == tuple(resolution)
+                  and close(m['gain'], gain)
+                  and (kind != 'dark' or exposure is None or close(m['exposure'], exposure))]
+    if not candidates:
+        return None
+    candidates.sort(key=lambda m: m['date'], reverse=True)
+    if temperature is not None:
+        candidates.sort(key=lambda m: abs(m['temperature'] - temperature) if m['temperature'] is not None else float('inf'))
+    return os.path.join(folder, candidates[0]['file'])
+
+def find_masters(folder, info):
+    '''
+    Finds the dark and flat matching a raw capture
+
+    Parameters
+    ----------
+    folder : str
+             The calibration folder
+
+    info   : dict
+             The sidecar of the capture, see rawwriter.read_info()
+
+    Returns
+    -------
+    dark   : str or None
+             Path of the master dark
+
+    flat   : str or None
+             Path of the master flat
+    '''
+    dark = find_master(folder, 'dark', info['sensor_mode'], info['resolution'], info['gain'],
+                       info['exposure'], info['temperature'])
+    flat = find_master(folder, 'flat', info['sensor_mode'], info['resolution'], info['gain'],
+                       temperature=info['temperature'])
+    return dark, flat
+
+def calibrate(luma, dark=None, flat=None):
+    '''
+    Calibrates a single luma plane
+
+    Parameters
+    ----------
+    luma : numpy.ndarray
+           2D uint8 image
+
+    dark : numpy.ndarray
+           Master dark of the same size, optional
+
+    flat : numpy.ndarray
+           Master flat (bias or dark subtracted) of the same size, optional
+
+    Returns
+    -------
+    calibrated : numpy.ndarray
+                 2D uint8 image
+    '''
+    result = luma.astype(np.float32)
+    if dark is not None:
+        result -= dark
+    if flat is not None:
+        result /= np.maximum(flat / flat.mean(), 1e-3)
+    return np.clip(result, 0, 255, out=result).astype(np.uint8)
+
+def apply(capture, output, dark=None, flat=None, offset=(0, 0)):
+    '''
+    Writes a calibrated copy of a raw capture, frame by frame
+
+    Parameters
+    ----------
+    capture : dict
+              As returned by framequality.open_capture(), only 'gray' and 'yuv' layouts are supported
+
+    output  : str
+              The file to write
+
+    dark    : numpy.ndarray
+              Master dark, optional
+
+    flat    : numpy.ndarray
+              Master flat, optional
+
+    offset  : tuple
+              Position of the capture's region of interest within the masters
+
+    Returns
+    -------
+    None
+    '''
+    if capture['layout'] == 'rgb':
+        raise ValueError('RGB captures cannot be calibrated with luma masters')
+    width, height = capture['width'], capture['height']
+    x, y = offset
+    if dark is not None:
+        dark = dark[y:y + height, x:x + width]
+    if flat is not None:
+        flat = flat[y:y + height, x:x + width]
+    frames = framequality.map_frames(capture)
+    with open(output, 'wb') as f:
+        for frame in frames:
+            f.write(calibrate(frame[:width * height].reshape(height, width), dark, flat))
+            f.write(frame[width * height:])
+
+def main():
+    parser = argparse.ArgumentParser(description='List or apply AstroBeaver calibration masters')
+    sub = parser.add_subparsers(dest='command', required=True)
+    listing = sub.add_parser('list', help='list the stored masters')
+    listing.add_argument('folder')
+    applying = sub.add_parser('apply', help='write a calibrated copy of a .yuv or .gray capture')
+    applying.add_argument('capture')
+    applying.add_argument('--dark', help='master dark (.npy)')
+    applying.add_argument('--flat', help='master flat (.npy)')
+    applying.add_argument('--offset', type=int, nargs=2, metavar=('X', 'Y'),
+                          help='position of the region of interest within the masters (default: from the sidecar)')
+    applying.add_argument('--masters', help='calibration folder to look up masters in (default: calibration next to the capture)')
+    applying.add_argument('--output', help='name of the calibrated copy')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for m in load_index(args.folder):
+            print('{file}: {kind}, mode {sensor_mode}, {resolution[0]}x{resolution[1]}, gain {gain:.2f}, '
+                  '{exposure}us, {temperature}C, {frames} frames ({method})'.format(**m))
+    else:
+        capture = framequality.open_capture(args.capture)
+        info = rawwriter.read_info(args.capture)
+        dark_file, flat_file = args.dark, args.flat
+        if dark_file is None and flat_file is None:
+            if info is None:
+                parser.error('{} has no sidecar, give the masters with --dark and --flat'.format(args.capture))
+            folder = args.masters or os.path.join(os.path.dirname(os.path.abspath(args.capture)), 'calibration')
+            dark_file, flat_file = find_masters(folder, info)
+            if dark_file is None and flat_file is None:
+                parser.error('no matching masters in {}'.format(folder))
+            print('dark: {}, flat: {}'.format(dark_file, flat_file))
+        if args.offset is not None:
+            offset = tuple(args.offset)
+        elif info is not None:
+            offset = tuple(info['crop'][:2])
+        else:
+            offset = (0, 0)
+        dark = np.load(dark_file) if dark_file else None
+        flat = np.load(flat_file) if flat_file else None
+        stem, ext = os.path.splitext(args.capture)
+        output = args.output or '{}_cal{}'.format(stem, ext)
+        apply(capture, output, dark, flat, offset)
+        print('wrote {}'.format(output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+'''
+    Name    : catalog
+
+    SQLite index of the captures recorded by AstroBeaver.
+
+    Every recording is added as soon as it is finished, so browsing a card never
+    has to walk the whole file tree. Folders are only rescanned (with os.scandir)
+    when their modification time differs from the one stored in the catalog.
+
+    Sequence folders (raw bursts and time-lapses, one file per frame) are catalogued as a
+    single capture, their frames are not listed.
+'''
+
+import os
+import re
+import sqlite3
+
+# file name pattern used by main() for all recordings, e.g. Video_1920x1088_08_05_2023_21_14_03_30s.h264
+# derived files add a suffix, e.g. Video_1920x1088_08_05_2023_21_14_03_30s_best25.yuv
+VIDEO_NAME = re.compile(r'^Video_(\d+)x(\d+)_.*?_(\d+)s(?:_\w+)?\.(\w+)$')
+
+# file extensions which are treated as captures, everything else on the card is ignored
+CAPTURE_FORMATS = ('h264', 'yuv', 'gray', 'abr')
+
+# folders written by the raw burst (Raw_4056x3040_<time>) and the time-lapse (Timelapse_<time>),
+# each of them is one capture
+SEQUENCE_NAME = re.compile(r'^(?:Raw_(\d+)x(\d+)|Timelapse)_\d\d_\d\d_\d{4}_\d\d_\d\d_\d\d$')
+
+# file extensions of the frames of a sequence folder
+SEQUENCE_FORMATS = ('dng', 'png')
+
+# bytes per pixel of the raw formats, used to derive the frame count from the file size
+RAW_BYTES_PER_PIXEL = {'yuv': 1.5, 'gray': 1.0}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS folders (
+    path    TEXT PRIMARY KEY,
+    parent  TEXT,
+    mtime   INTEGER
+);
+CREATE TABLE IF NOT EXISTS captures (
+    path        TEXT PRIMARY KEY,
+    folder      TEXT,
+    name        TEXT,
+    format      TEXT,
+    width       INTEGER,
+    height      INTEGER,
+    duration    REAL,
+    size        INTEGER,
+    mtime       INTEGER,
+    gain        REAL,
+    frames      INTEGER,
+    score       REAL
+);
+CREATE INDEX IF NOT EXISTS captures_folder ON captures (folder);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+'''
+
+def open_catalog(filename):
+    '''
+    Opens (and if needed creates) the catalog database
+
+    Parameters
+    ----------
+    filename : str
+               Path of the SQLite file, usually in a hidden folder next to the videos on the card.
+               It should not be placed directly in a catalogued folder, since every commit
+               would change the modification time of that folder and force a rescan.
+
+    Returns
+    -------
+    db       : sqlite3.Connection
+               The open catalog
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    db = sqlite3.connect(filename)
+    db.executescript(SCHEMA)
+    return db
+
+def parse_name(filename):
+    '''
+    Extracts format, resolution and duration from a capture file name
+
+    Parameters
+    ----------
+    filename : str
+               Name or path of the capture
+
+    Returns
+    -------
+    info     : dict
+               format, width, height and duration, None for everything that could not be parsed
+    '''
+    name = os.path.basename(filename)
+    info = {'format': os.path.splitext(name)[1][1:].lower() or None, 'width': None, 'height': None, 'duration': None}
+    match = VIDEO_NAME.match(name)
+    if match:
+        info['width'] = int(match.group(1))
+        info['height'] = int(match.group(2))
+        info['duration'] = float(match.group(3))
+    return info
+
+def frame_count(fmt, resolution, size):
+    '''
+    Derives the number of frames of a raw capture from its size
+
+    Parameters
+    ----------
+    fmt        : str
+                 File format / extension of the capture
+
+    resolution : tuple
+                 Width and height of a single frame as written to disk
+
+    size       : int
+                 File size in bytes
+
+    Returns
+    -------
+    frames     : int or None
+                 Number of frames, None for compressed formats
+    '''
+    if fmt not in RAW_BYTES_PER_PIXEL or None in resolution:
+        return None
+    frame_bytes = int(resolution[0] * resolution[1] * RAW_BYTES_PER_PIXEL[fmt])
+    return size // frame_bytes
+
+def add_capture(db, filename, resolution=None, duration=None, gain=None, frames=None, score=None, commit=True):
+    '''
+    Adds or refreshes a single capture, called by main() when a recording is finished
+
+    Parameters
+    ----------
+    db         : sqlite3.Connection
+                 The open catalog
+
+    filename   : str
+                 Path of the capture
+
+    resolution : tuple
+                 Width and height of the frames, parsed from the file name if not given
+
+    duration   : float
+                 Recording time in seconds, parsed from the file name if not given
+
+    gain       : float
+                 Total gain (analog * digital) used for the recording
+
+    frames     : int
+                 Number of frames, derived from the file size for raw formats if not given
+
+    score      : float
+                 Focus/quality score of the capture
+
+    commit     : bool
+                 Commit right away, scan_folder() commits once per folder instead
+
+    Returns
+    -------
+    None
+    '''
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    info = parse_name(filename)
+    if resolution is None:
+        resolution = (info['width'], info['height'])
+    if duration is None:
+        duration = info['duration']
+    if frames is None:
+        frames = frame_count(info['format'], resolution, st.st_size)
+
+    # keep gain and score of an earlier entry if they are not known this time (e.g. on a rescan)
+    old = db.execute('SELECT gain, score FROM captures WHERE path = ?', (filename,)).fetchone()
+    if old is not None:
+        gain = old[0] if gain is None else gain
+        score = old[1] if score is None else score
+
+    db.execute('INSERT OR REPLACE INTO captures VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+               (filename, os.path.dirname(filename), os.path.basename(filename), info['format'],
+                resolution[0], resolution[1], duration, st.st_size, st.st_mtime_ns, gain, frames, score))
+    if commit:
+        db.commit()
+
+def add_sequence(db, dirname, commit=True):
+    '''
+    Adds or refreshes a sequence folder (raw burst or time-lapse) as a single capture
+
+    Parameters
+    ----------
+    db      : sqlite3.Connection
+              The open catalog
+
+    dirname : str
+              The sequence folder
+
+    commit  : bool
+              Commit right away, scan_folder() commits once per folder instead
+
+    Returns
+    -------
+    None
+    '''
+    dirname = os.path.abspath(dirname)
+    match = SEQUENCE_NAME.match(os.path.basename(dirname))
+    if match and match.group(1):
+        fmt, width, height = 'dng', int(match.group(1)), int(match.group(2))
+    else:
+        fmt, width, height = 'png', None, None
+    frames = 0
+    size = 0
+    with os.scandir(dirname) as it:
+        for entry in it:
+            if os.path.splitext(entry.name)[1][1:].lower() == fmt and entry.is_file():
+                frames += 1
+                size += entry.stat().st_size
+    db.execute('INSERT OR REPLACE INTO captures VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+               (dirname, os.path.dirname(dirname), os.path.basename(dirname), fmt, width, height, None, size,
+                os.stat(dirname).st_mtime_ns, None, frames, None))
+    if commit:
+        db.commit()
+
+def set_score(db, filename, score):
+    '''
+    Stores the focus/quality score of a capture
+
+    Parameters
+    ----------
+    db       : sqlite3.Connection
+               The open catalog
+
+    filename : str
+               Path of the capture
+
+    score    : float
+               The new score
+
+    Returns
+    -------
+    None
+    '''
+    db.execute('UPDATE captures SET score = ? WHERE path = ?', (score, os.path.abspath(filename)))
+    db.commit()
+
+def scan_folder(db, dirname):
+    '''
+    Brings the catalog entries of a single folder (not recursive) up to date
+
+    The folder is only listed if its modification time changed since the last scan,
+    and only files that are new or changed are stat'ed in detail.
+
+    Parameters
+    ----------
+    db      : sqlite3.Connection
+              The open catalog
+
+    dirname : str
+              The folder to scan
+
+    Returns
+    -------
+    changed : bool
+              True if the folder had to be rescanned
+    '''
+    dirname = os.path.abspath(dirname)
+    mtime = os.stat(dirname).st_mtime_ns
+    row = db.execute('SELECT mtime FROM folders WHERE path = ?', (dirname,)).fetchone()
+    if row is not None and row[0] == mtime:
+        return False
+
+    known = dict(db.execute('SELECT path, mtime FROM captures WHERE folder = ?', (dirname,)).fetchall())
+    folders = []
+    with os.scandir(dirname) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                if SEQUENCE_NAME.match(entry.name):
+                    if known.pop(entry.path, None) != entry.stat().st_mtime_ns:
+                        add_sequence(db, entry.path, commit=False)
+                else:
+                    folders.append(entry.path)
+            elif entry.is_file() and parse_name(entry.name)['format'] in CAPTURE_FORMATS:
+                if known.pop(entry.path, None) != entry.stat().st_mtime_ns:
+                    add_capture(db, entry.path, commit=False)
+
+    # forget captures and sub folders which vanished
+    db.executemany('DELETE FROM captures WHERE path = ?', [(path,) for path in known])
+    old_folders = {path for (path,) in db.execute('SELECT path FROM folders WHERE parent = ?', (dirname,))}
+    for path in old_folders.difference(folders):
+        forget_folder(db, path)
+    db.executemany('INSERT OR IGNORE INTO folders VALUES (?,?,NULL)', [(path, dirname) for path in folders])
+
+    db.execute('INSERT OR REPLACE INTO folders VALUES (?,?,?)', (dirname, os.path.dirname(dirname), mtime))
+    db.commit()
+    return True
+
+def forget_folder(db, dirname):
+    '''
+    Removes a folder and everything below it from the catalog
+
+    Parameters
+    ----------
+    db      : sqlite3.Connection
+              The open catalog
+
+    dirname : str
+              The folder to remove
+
+    Returns
+    -------
+    None
+    '''
+    for (path,) in db.execute('SELECT path FROM folders WHERE parent = ?', (dirname,)).fetchall():
+        forget_folder(db, path)
+    db.execute('DELETE FROM captures WHERE folder = ?', (dirname,))
+    db.execute('DELETE FROM folders WHERE path = ?', (dirname,))
+
+def list_folder(db, dirname):
+    '''
+    Returns the content of a folder as stored in the catalog, rescanning it first if it changed
+
+    Parameters
+    ----------
+    db       : sqlite3.Connection
+               The open catalog
+
+    dirname  : str
+               The folder to list
+
+    Returns
+    -------
+    folders  : List[str]
+               Paths of the sub folders
+
+    captures : List[tuple]
+               (path, name, format, width, height, duration, size, gain, frames, score) of every capture
+    '''
+    dirname = os.path.abspath(dirname)
+    scan_folder(db, dirname)
+    # frames written into a sequence folder do not change the modification time of its parent
+    for path, mtime in db.execute('SELECT path, mtime FROM captures WHERE folder = ? AND format IN ({})'.format(
+            ','.join('?' * len(SEQUENCE_FORMATS))), (dirname,) + SEQUENCE_FORMATS).fetchall():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                add_sequence(db, path)
+        except FileNotFoundError:
+            pass
+    folders = [path for (path,) in db.execute('SELECT path FROM folders WHERE parent = ? ORDER BY path', (dirname,))]
+    captures = db.execute('SELECT path, name, format, width, height, duration, size, gain, frames, score '
+                          'FROM captures WHERE folder = ? ORDER BY name', (dirname,)).fetchall()
+    return folders, captures
@@ -0,0 +1,254 @@
+'''
+    Name    : framequality
+
+    Offline frame quality ranking and trimming of recorded captures.
+
+    The capture (.yuv, .gray or .ser) is memory mapped and split into frame ranges which are
+    scored by worker processes. Sharpness is the variance of the Laplacian of the luma plane,
+    brightness its mean. The ranking is written as CSV and optionally a trimmed copy with only
+    the best frames (in their original order) is written, so bad seeing can be culled before
+    copying multi-GB files off the card.
+
+    Usage
+    -----
+    python3 framequality.py Video_1014x608_08_05_2023_21_14_03_30s.gray --keep 25
+'''
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import catalog
+import serfile
+
+def open_capture(filename):
+    '''
+    Describes the frame layout of a raw capture
+
+    Parameters
+    ----------
+    filename : str
+               .yuv or .gray capture named by main(), or a .ser file
+
+    Returns
+    -------
+    capture  : dict
+               path, offset of the first frame, frame_bytes, frames, width, height and layout ('yuv', 'gray' or 'rgb')
+    '''
+    size = os.path.getsize(filename)
+    if filename.lower().endswith('.ser'):
+        with open(filename, 'rb') as f:
+            header = serfile.read_header(f)
+        if header['depth'] > 8:
+            raise ValueError('only 8 bit SER files are supported')
+        layout = 'rgb' if header['channels'] == 3 else 'gray'
+        frame_bytes = header['width'] * header['height'] * header['channels']
+        frames = min(header['frames'], (size - serfile.HEADER_SIZE) // frame_bytes)
+        return {'path': filename, 'offset': serfile.HEADER_SIZE, 'frame_bytes': frame_bytes, 'frames': frames,
+                'width': header['width'], 'height': header['height'], 'layout': layout}
+
+    info = catalog.parse_name(filename)
+    if info['format'] not in ('yuv', 'gray') or info['width'] is None:
+        raise ValueError('{} is not a raw capture recorded by AstroBeaver'.format(filename))
+    frame_bytes = int(info['width'] * info['height'] * catalog.RAW_BYTES_PER_PIXEL[info['format']])
+    return {'path': filename, 'offset': 0, 'frame_bytes': frame_bytes, 'frames': size // frame_bytes,
+            'width': info['width'], 'height': info['height'], 'layout': info['format']}
+
+def map_frames(capture):
+    '''
+    Memory maps all frames of a capture
+
+    Returns
+    -------
+    frames : numpy.memmap
+             (frames, frame bytes) uint8 array
+    '''
+    return np.memmap(capture['path'], dtype=np.uint8, mode='r', offset=capture['offset'],
+                     shape=(capture['frames'], capture['frame_bytes']))
+
+def luma(frame, capture):
+    '''
+    Returns the luma plane of a single frame as float32 image
+    '''
+    width, height = capture['width'], capture['height']
+    if capture['layout'] == 'rgb':
+        rgb = frame.reshape(height, width, 3).astype(np.float32)
+        return 0.299 * rgb[..., 0] + 0.587 * rgb[..., 1] + 0.114 * rgb[..., 2]
+    return frame[:width * height].reshape(height, width).astype(np.float32)
+
+def score_frame(y):
+    '''
+    Scores a single luma image
+
+    Parameters
+    ----------
+    y          : numpy.ndarray
+                 2D float32 luma image
+
+    Returns
+    -------
+    sharpness  : float
+                 Variance of the Laplacian
+
+    brightness : float
+                 Mean value
+    '''
+    laplacian = 4 * y[1:-1, 1:-1] - y[:-2, 1:-1] - y[2:, 1:-1] - y[1:-1, :-2] - y[1:-1, 2:]
+    return float(laplacian.var()), float(y.mean())
+
+def score_range(capture, start, stop):
+    '''
+    Scores the frames start..stop-1, run in a worker process
+
+    Returns
+    -------
+    start  : int
+             First frame of the range
+
+    scores : numpy.ndarray
+             (n, 2) array of sharpness and brightness
+    '''
+    frames = map_frames(capture)
+    scores = np.empty((stop - start, 2))
+    for i in range(start, stop):
+        scores[i - start] = score_frame(luma(frames[i], capture))
+    return start, scores
+
+def rank(capture, workers=None, ranges_per_worker=4):
+    '''
+    Scores all frames of a capture in parallel
+
+    Parameters
+    ----------
+    capture           : dict
+                        As returned by open_capture()
+
+    workers           : int
+                        Number of worker processes, all cores if not given
+
+    ranges_per_worker : int
+                        Number of frame ranges handed to each worker, more ranges balance the load better
+
+    Returns
+    -------
+    scores            : numpy.ndarray
+                        (frames, 2) array of sharpness and brightness
+    '''
+    workers = workers or os.cpu_count()
+    n = capture['frames']
+    step = max(1, -(-n // (workers * ranges_per_worker)))
+    scores = np.empty((n, 2))
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(score_range, capture, start, min(start + step, n)) for start in range(0, n, step)]
+        for job in jobs:
+            start, part = job.result()
+            scores[start:start + len(part)] = part
+    return scores
+
+def best_frames(scores, keep):
+    '''
+    Selects the sharpest frames
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+             As returned by rank()
+
+    keep   : float
+             Percentage of frames to keep
+
+    Returns
+    -------
+    frames : numpy.ndarray
+             Indices of the best frames in their original order
+    '''
+    n = max(1, int(round(len(scores) * keep / 100.0)))
+    return np.sort(np.argsort(-scores[:, 0], kind='stable')[:n])
+
+def write_ranking(filename, scores):
+    '''
+    Writes the frames ordered from best to worst as CSV
+
+    Returns
+    -------
+    None
+    '''
+    order = np.argsort(-scores[:, 0], kind='stable')
+    with open(filename, 'w') as f:
+        f.write('rank,frame,sharpness,brightness\n')
+        for position, i in enumerate(order):
+            f.write('{},{},{:.3f},{:.3f}\n'.format(position + 1, i, scores[i, 0], scores[i, 1]))
+
+def trim(capture, selection, filename):
+    '''
+    Writes a copy of the capture containing only the selected frames
+
+    Parameters
+    ----------
+    capture   : dict
+                As returned by open_capture()
+
+    selection : numpy.ndarray
+                Indices of the frames to keep, ascending
+
+    filename  : str
+                The output file, same format as the capture
+
+    Returns
+    -------
+    None
+    '''
+    frames = map_frames(capture)
+    with open(capture['path'], 'rb') as src, open(filename, 'wb') as dst:
+        if capture['offset']:
+            dst.write(src.read(capture['offset']))
+            serfile.set_frame_count(dst, len(selection))
+        for i in selection:
+            dst.write(frames[i])
+        if capture['offset']:
+            # keep the per frame time stamps of the SER trailer if there are any
+            trailer = capture['offset'] + capture['frames'] * capture['frame_bytes']
+            if os.path.getsize(capture['path']) >= trailer + 8 * capture['frames']:
+                src.seek(trailer)
+                stamps = np.frombuffer(src.read(8 * capture['frames']), dtype='<i8')
+                dst.write(stamps[selection].tobytes())
+
+def trimmed_name(filename, keep):
+    '''
+    Name of the trimmed copy, e.g. Video_..._30s_best25.gray
+    '''
+    stem, ext = os.path.splitext(filename)
+    return '{}_best{}{}'.format(stem, int(keep), ext)
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank the frames of a raw capture by sharpness and keep the best ones')
+    parser.add_argument('capture', help='.yuv, .gray or .ser file')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--keep', type=float, default=None, help='write a trimmed copy with the best KEEP percent of the frames')
+    parser.add_argument('--output', default=None, help='name of the trimmed copy')
+    parser.add_argument('--catalog', default=None, help='capture catalog to store the quality score in')
+    args = parser.parse_args()
+
+    capture = open_capture(args.capture)
+    start = time.monotonic()
+    scores = rank(capture, args.workers)
+    elapsed = time.monotonic() - start
+    print('scored {} frames in {:.1f}s ({:.1f} frames/s)'.format(capture['frames'], elapsed, capture['frames'] / max(elapsed, 1e-6)))
+
+    write_ranking(args.capture + '.rank.csv', scores)
+
+    if args.catalog:
+        # quality of the capture is the median sharpness of its best 10% frames
+        db = catalog.open_catalog(args.catalog)
+        catalog.set_score(db, args.capture, float(np.median(scores[best_frames(scores, 10), 0])))
+        db.close()
+
+    if args.keep:
+        selection = best_frames(scores, args.keep)
+        output = args.output or trimmed_name(args.capture, args.keep)
+        trim(capture, selection, output)
+        print('wrote {} of {} frames to {}'.format(len(selection), capture['frames'], output))
+
+if __name__ == '__main__':
+    main()
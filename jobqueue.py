@@ -0,0 +1,302 @@
+'''
+    Name    : jobqueue
+
+    Persistent queue for post-capture work (scoring frames, thumbnails, exporting containers).
+
+    Jobs are stored in SQLite, so queued jobs survive a restart and are picked up again on the next
+    launch. They are run by low priority worker processes (niced and limited to some CPU cores)
+    while the next capture proceeds. During a recording the workers are throttled to a single one,
+    which only runs for a part of the time (SIGSTOP / SIGCONT duty cycle), and all of them are
+    paused as soon as the writer of the recording falls behind.
+'''
+
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import time
+import traceback
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind        TEXT,
+    args        TEXT,
+    state       TEXT,
+    created     REAL,
+    finished    REAL,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+'''
+
+# the GUI process runs Tk and picamera threads, forking it could deadlock the workers,
+# so they are started from a clean server process
+MP_CONTEXT = 'forkserver'
+
+# seconds a worker sleeps when there is nothing to do
+IDLE_TIME = 2.0
+
+# during a recording a worker runs RECORDING_DUTY of every DUTY_PERIOD seconds
+RECORDING_DUTY = 0.25
+DUTY_PERIOD = 4.0
+
+def task_score(capture, catalog_file=None):
+    '''
+    Ranks the frames of a raw capture, writes the ranking and stores the quality score in the catalog
+
+    Parameters
+    ----------
+    capture      : str
+                   .yuv, .gray, .ser or .abr file
+
+    catalog_file : str
+                   Capture catalog to store the score in, optional
+    '''
+    import numpy as np
+    import catalog
+    import framequality
+    if capture.endswith('.abr'):
+        import rawcontainer
+        reader = rawcontainer.ContainerReader(capture)
+        layout = {'width': reader.width, 'height': reader.height, 'layout': 'gray'}
+        scores = np.array([framequality.score_frame(framequality.luma(frame, layout)) for frame in reader])
+        reader.close()
+    else:
+        info = framequality.open_capture(capture)
+        _, scores = framequality.score_range(info, 0, info['frames'])
+    framequality.write_ranking(capture + '.rank.csv', scores)
+    if catalog_file is not None:
+        db = catalog.open_catalog(catalog_file)
+        catalog.set_score(db, capture, float(np.median(scores[framequality.best_frames(scores, 10), 0])))
+        db.close()
+
+def task_thumbnail(capture, thumbnail, size=(160, 120)):
+    '''
+    Writes a small PNG of the first frame of a raw capture
+
+    Parameters
+    ----------
+    capture   : str
+                .yuv, .gray, .ser or .abr file
+
+    thumbnail : str
+                The PNG file to write
+
+    size      : tuple
+                Maximum width and height of the thumbnail
+    '''
+    import numpy as np
+    from PIL import Image
+    import framequality
+    import rawcontainer
+    if capture.endswith('.abr'):
+        reader = rawcontainer.ContainerReader(capture)
+        frame, width, height = reader.frame(0), reader.width, reader.height
+        layout = 'gray' if reader.format == rawcontainer.GRAY else 'yuv'
+        reader.close()
+    else:
+        info = framequality.open_capture(capture)
+        frame, width, height, layout = framequality.map_frames(info)[0], info['width'], info['height'], info['layout']
+    if layout == 'yuv':
+        image = Image.fromarray(rawcontainer.i420_to_rgb(frame, width, height))
+    elif layout == 'rgb':
+        image = Image.fromarray(np.asarray(frame).reshape(height, width, 3))
+    else:
+        image = Image.fromarray(np.asarray(frame[:width * height]).reshape(height, width))
+    image.thumbnail(size)
+    os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+    image.save(thumbnail)
+
+def task_export(source, destination):
+    '''
+    Exports a compressed container to SER or plain raw frames
+    '''
+    import rawcontainer
+    rawcontainer.export(source, destination)
+
+TASKS = {
+    'score': task_score,
+    'thumbnail': task_thumbnail,
+    'export': task_export,
+}
+
+def open_jobs(filename):
+    '''
+    Opens (and if needed creates) the job database
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    db = sqlite3.connect(filename, timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+def claim(db):
+    '''
+    Takes the oldest pending job, atomically, so several workers never run the same job
+
+    Returns
+    -------
+    job : tuple or None
+          (id, kind, args) of the claimed job, None if there is nothing to do
+    '''
+    db.execute('BEGIN IMMEDIATE')
+    job = db.execute("SELECT id, kind, args FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+    if job is not None:
+        db.execute("UPDATE jobs SET state = 'running' WHERE id = ?", (job[0],))
+    db.commit()
+    return job
+
+def worker(filename, stop, nice, cpus):
+    '''
+    Main function of a worker process
+
+    Parameters
+    ----------
+    filename : str
+               The job database
+
+    stop     : multiprocessing.Event
+               Set when the worker should exit after the current job
+
+    nice     : int
+               Niceness added to the process
+
+    cpus     : set
+               CPU cores the worker may run on, None for all
+    '''
+    os.nice(nice)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        cpus = set(cpus) & os.sched_getaffinity(0)
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+    # the GUI process handles ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    db = open_jobs(filename)
+    while not stop.is_set():
+        job = claim(db)
+        if job is None:
+            stop.wait(IDLE_TIME)
+            continue
+        id, kind, args = job
+        try:
+            TASKS[kind](**json.loads(args))
+            db.execute("UPDATE jobs SET state = 'done', finished = ? WHERE id = ?", (time.time(), id))
+        except Exception:
+            db.execute("UPDATE jobs SET state = 'failed', finished = ?, error = ? WHERE id = ?",
+                       (time.time(), traceback.format_exc(), id))
+        db.commit()
+    db.close()
+
+class JobQueue:
+    '''
+    Persistent queue of post-capture jobs with low priority worker processes
+
+    Parameters
+    ----------
+    filename : str
+               The job database
+
+    workers  : int
+               Number of worker processes
+
+    cpus     : set
+               CPU cores the workers may run on, None for all
+
+    nice     : int
+               Niceness added to the workers
+    '''
+    def __init__(self, filename, workers=1, cpus=None, nice=19):
+        self.filename = filename
+        self.db = open_jobs(filename)
+        # jobs which were running when the program ended are started again
+        resumed = self.db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'").rowcount
+        self.db.commit()
+        if resumed:
+            print('job queue: {} interrupted jobs queued again'.format(resumed))
+        context = multiprocessing.get_context(MP_CONTEXT)
+        self.stop = context.Event()
+        self.processes = [context.Process(target=worker, args=(filename, self.stop, nice, cpus), daemon=True)
+                          for _ in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.stopped = set()
+
+    def add(self, kind, **args):
+        '''
+        Queues a job
+
+        Parameters
+        ----------
+        kind : str
+               Name of the task, see TASKS
+
+        args :
+               Keyword arguments of the task, must be JSON serialisable
+
+        Returns
+        -------
+        None
+        '''
+        if kind not in TASKS:
+            raise ValueError('unknown job {}'.format(kind))
+        self.db.execute("INSERT INTO jobs (kind, args, state, created) VALUES (?, ?, 'pending', ?)",
+                        (kind, json.dumps(args), time.time()))
+        self.db.commit()
+
+    def pending(self):
+        '''
+        Returns the number of queued and running jobs
+        '''
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')").fetchone()[0]
+
+    def _run(self, active):
+        '''
+        Lets the first *active* workers run and stops all others
+        '''
+        for i, process in enumerate(self.processes):
+            if process.pid is None or not process.is_alive():
+                continue
+            if i < active and i in self.stopped:
+                os.kill(process.pid, signal.SIGCONT)
+                self.stopped.discard(i)
+            elif i >= active and i not in self.stopped:
+                os.kill(process.pid, signal.SIGSTOP)
+                self.stopped.add(i)
+
+    def monitor(self, recording, behind=False):
+        '''
+        Adapts the workers to the state of the capture, called regularly (about every 0.5 s) by the capture loops
+
+        Parameters
+        ----------
+        recording : bool
+                    A recording is active
+
+        behind    : bool
+                    The writer of the recording falls behind
+
+        Returns
+        -------
+        None
+        '''
+        if not recording:
+            self._run(len(self.processes))
+        elif behind:
+            self._run(0)
+        else:
+            # one worker, and only for a part of the time, even if only one is configured
+            self._run(1 if time.monotonic() % DUTY_PERIOD < RECORDING_DUTY * DUTY_PERIOD else 0)
+
+    def close(self):
+        '''
+        Stops the workers, a job which is still running is queued again on the next launch
+        '''
+        self.stop.set()
+        self._run(len(self.processes))
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.db.close()
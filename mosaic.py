@@ -0,0 +1,162 @@
+'''
+    Name    : mosaic
+
+    Automated mosaic sweep for full disc Moon and Sun mosaics.
+
+    An overlapping grid of digital ROIs (camera.zoom rectangles of the size of the current ROI)
+    is computed over the sensor and every panel is recorded back to back into its own H264 file.
+    The recording is never stopped: the zoom is moved and the stream is split into the next file
+    with split_recording(), so there is neither a camera reinit nor a pipeline restart between
+    two panels. A manifest with the panel geometry and time stamps is written for stitching.
+
+    The ROI is moved before the split, so the last frames of every file already show the next
+    panel. Their number is stored as discard_frames of the panel in the manifest ('end' is the
+    time the ROI was moved, 'file_end' the time of the split).
+'''
+
+import json
+import math
+import time
+from datetime import datetime
+
+def axis_positions(size, overlap):
+    '''
+    Start positions of the panels along one axis of the sensor
+
+    Parameters
+    ----------
+    size    : float
+              Panel size as fraction of the sensor
+
+    overlap : float
+              Minimum overlap of neighbouring panels as fraction of the panel size
+
+    Returns
+    -------
+    positions : List[float]
+                Evenly spread start positions, the first panel starts at 0 and the last one ends at 1
+    '''
+    if size >= 1.0:
+        return [0.0]
+    n = math.ceil((1.0 - size) / (size * (1.0 - overlap)) - 1e-9) + 1
+    return [i * (1.0 - size) / (n - 1) for i in range(n)]
+
+def mosaic_grid(panel, overlap=0.2):
+    '''
+    Computes the panels of the mosaic
+
+    The rows are swept in alternating direction, so consecutive panels are always neighbours.
+
+    Parameters
+    ----------
+    panel   : tuple
+              Width and height of a panel as fraction of the sensor, i.e. camera.zoom[2:]
+
+    overlap : float
+              Minimum overlap of neighbouring panels as fraction of the panel size
+
+    Returns
+    -------
+    panels  : List[dict]
+              row, col and zoom rectangle (x, y, w, h) of every panel in recording order
+    '''
+    xs = axis_positions(panel[0], overlap)
+    ys = axis_positions(panel[1], overlap)
+    panels = []
+    for row, y in enumerate(ys):
+        cols = list(enumerate(xs))
+        if row % 2:
+            cols.reverse()
+        for col, x in cols:
+            panels.append({'row': row, 'col': col, 'zoom': (x, y, panel[0], panel[1])})
+    return panels
+
+def record_mosaic(camera, panels, filename, duration, sensor_resolution, manifest, settle_frames=2, wait=None):
+    '''
+    Records all panels back to back
+
+    Parameters
+    ----------
+    camera            : picamera.camera.PiCamera
+                        The picamera camera object
+
+    panels            : List[dict]
+                        As returned by mosaic_grid()
+
+    filename          : str
+                        File name pattern with {row} and {col} placeholders
+
+    duration          : float
+                        Recording time per panel in seconds
+
+    sensor_resolution : tuple
+                        Resolution of the sensor mode, used for the pixel geometry in the manifest
+
+    manifest          : str
+                        JSON file the layout is written to
+
+    settle_frames     : int
+                        Frames to wait after moving the ROI before the stream is split
+
+    wait              : callable
+                        wait(seconds) records a panel, e.g. to keep the post-capture jobs throttled
+                        while waiting, camera.wait_recording if not given
+
+    Returns
+    -------
+    sweep_time        : float
+                        Seconds from the start of the first to the end of the last panel
+    '''
+    if wait is None:
+        wait = camera.wait_recording
+    framerate = float(camera.framerate)
+    frame_time = 1.0 / framerate
+    start = time.monotonic()
+    previous = None
+    recording = False
+    try:
+        for panel in panels:
+            panel['file'] = filename.format(row=panel['row'], col=panel['col'])
+            moved = time.monotonic() - start
+            camera.zoom = panel['zoom']
+            if previous is None:
+                # nothing is recorded yet, just give the ISP time to apply the ROI
+                time.sleep(settle_frames * frame_time)
+                camera.start_recording(panel['file'], format='h264', quality=10, bitrate=0)
+                recording = True
+            else:
+                # give the ISP time to apply the new ROI, then force a key frame: the split happens at
+                # the next one and until then all frames go into the file of the previous panel
+                camera.wait_recording(settle_frames * frame_time)
+                camera.request_key_frame()
+                camera.split_recording(panel['file'])
+            panel['start'] = time.monotonic() - start
+            panel['time'] = datetime.now().isoformat(timespec='milliseconds')
+            if previous is not None:
+                # the tail of the previous file was recorded after the ROI was moved and has to be discarded
+                previous['end'] = moved
+                previous['file_end'] = panel['start']
+                previous['discard_frames'] = math.ceil((panel['start'] - moved) * framerate)
+            wait(duration)
+            previous = panel
+    finally:
+        # also stop if a split failed (e.g. timed out), otherwise the camera keeps recording
+        if recording:
+            camera.stop_recording()
+    sweep_time = time.monotonic() - start
+    previous['end'] = previous['file_end'] = sweep_time
+    previous['discard_frames'] = 0
+
+    width, height = sensor_resolution
+    for panel in panels:
+        x, y, w, h = panel['zoom']
+        panel['sensor_rect'] = (round(x * width), round(y * height), round(w * width), round(h * height))
+    with open(manifest, 'w') as f:
+        json.dump({'sensor_resolution': list(sensor_resolution),
+                   'recording_resolution': list(camera.resolution),
+                   'rows': max(panel['row'] for panel in panels) + 1,
+                   'cols': max(panel['col'] for panel in panels) + 1,
+                   'panel_duration': duration,
+                   'sweep_time': sweep_time,
+                   'panels': panels}, f, indent=1)
+    return sweep_time
@@ -0,0 +1,329 @@
+'''
+    Name    : rawburst
+
+    Raw Bayer burst capture with parallel DNG writing.
+
+    The still port delivers a JPEG with the raw sensor data (12 bit packed for the HQ camera)
+    appended. Only the raw tail is kept: it is copied into one of a few preallocated shared memory
+    buffers and handed over to a pool of worker processes, which unpack the 12 bit data with
+    vectorised NumPy operations and write the DNG with pidng. The capture loop only waits if all
+    buffers are still in use.
+'''
+
+import os
+import time
+from collections import deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# size of the 'BRCM' header in front of the raw data
+RAW_HEADER = 32768
+
+# the firmware adds some rows of padding below the image (16 for the full resolution mode)
+MAX_EXTRA_ROWS = 32
+
+# resolution of the full sensor, used for sensor mode 0 (auto)
+FULL_RESOLUTION = (4056, 3040)
+
+# unpacked image of the worker process, reused for every frame of the same size
+_image = None
+
+def raw_geometry(resolution):
+    '''
+    Layout of the 12 bit packed raw data of the HQ camera
+
+    Parameters
+    ----------
+    resolution : tuple
+                 Width and height of the sensor mode
+
+    Returns
+    -------
+    stride     : int
+                 Bytes per row (padded to 32)
+
+    size       : int
+                 Largest possible size of the raw block including the 'BRCM' header
+    '''
+    width, height = resolution
+    stride = ((width * 3 // 2 + 31) // 32) * 32
+    return stride, RAW_HEADER + stride * (height + MAX_EXTRA_ROWS)
+
+def unpack12(data, resolution, stride, out=None):
+    '''
+    Unpacks MIPI RAW12 data, two pixels are packed into three bytes:
+    high bits of pixel 0, high bits of pixel 1, low nibbles of both
+
+    Parameters
+    ----------
+    data       : numpy.ndarray
+                 Flat uint8 array of the raw rows (without 'BRCM' header)
+
+    resolution : tuple
+                 Width and height of the image
+
+    stride     : int
+                 Bytes per row
+
+    out        : numpy.ndarray
+                 (height, width) uint16 array to unpack into, allocated if not given
+
+    Returns
+    -------
+    image      : numpy.ndarray
+                 (height, width) uint16 array with 12 bit values
+    '''
+    width, height = resolution
+    packed = data[:height * stride].reshape(height, stride)[:, :width * 3 // 2].reshape(height, width // 2, 3)
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint16)
+    high = packed[..., :2].astype(np.uint16) << 4
+    low = packed[..., 2]
+    out[:, 0::2] = high[..., 0] | (low & 0x0F)
+    out[:, 1::2] = high[..., 1] | (low >> 4)
+    return out
+
+def dng_tags(resolution, bits=12):
+    '''
+    DNG tags for a raw frame of the HQ camera (IMX477, BGGR pattern)
+    '''
+    from pidng.core import DNGTags, Tag
+    from pidng.defs import (CalibrationIlluminant, CFAPattern, DNGVersion, Orientation,
+                            PhotometricInterpretation, PreviewColorSpace)
+    width, height = resolution
+    # colour matrix of the IMX477 as used by pidng's RPICAM2DNG
+    ccm = [[6759, 10000], [-2379, 10000], [751, 10000],
+           [-4432, 10000], [13871, 10000], [5465, 10000],
+           [-401, 10000], [1664, 10000], [7845, 10000]]
+    t = DNGTags()
+    t.set(Tag.ImageWidth, width)
+    t.set(Tag.ImageLength, height)
+    t.set(Tag.TileWidth, width)
+    t.set(Tag.TileLength, height)
+    t.set(Tag.Orientation, Orientation.Horizontal)
+    t.set(Tag.PhotometricInterpretation, PhotometricInterpretation.Color_Filter_Array)
+    t.set(Tag.SamplesPerPixel, 1)
+    t.set(Tag.BitsPerSample, bits)
+    t.set(Tag.CFARepeatPatternDim, [2, 2])
+    t.set(Tag.CFAPattern, CFAPattern.BGGR)
+    t.set(Tag.BlackLevel, 256)
+    t.set(Tag.WhiteLevel, (1 << bits) - 1)
+    t.set(Tag.ColorMatrix1, ccm)
+    t.set(Tag.CalibrationIlluminant1, CalibrationIlluminant.D65)
+    t.set(Tag.AsShotNeutral, [[1, 1], [1, 1], [1, 1]])
+    t.set(Tag.BaselineExposure, [[1, 1]])
+    t.set(Tag.Make, 'RaspberryPi')
+    t.set(Tag.Model, 'RP_imx477')
+    t.set(Tag.DNGVersion, DNGVersion.V1_4)
+    t.set(Tag.DNGBackwardVersion, DNGVersion.V1_2)
+    t.set(Tag.PreviewColorSpace, PreviewColorSpace.sRGB)
+    return t
+
+def write_dng(slot, name, offset, resolution, filename):
+    '''
+    Unpacks a raw frame from shared memory and writes it as DNG, run in a worker process
+
+    Parameters
+    ----------
+    slot       : int
+                 Index of the buffer, returned so the capture loop can reuse it
+
+    name       : str
+                 Name of the shared memory block
+
+    offset     : int
+                 Position of the 'BRCM' header within the block
+
+    resolution : tuple
+                 Width and height of the frame
+
+    filename   : str
+                 DNG file to write, without extension
+
+    Returns
+    -------
+    slot       : int
+                 The buffer index
+    '''
+    global _image
+    from pidng.core import RAW2DNG
+    stride, size = raw_geometry(resolution)
+    if _image is None or _image.shape != (resolution[1], resolution[0]):
+        _image = np.empty((resolution[1], resolution[0]), dtype=np.uint16)
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((size,), dtype=np.uint8, buffer=shm.buf)
+    unpack12(data[offset + RAW_HEADER:], resolution, stride, out=_image)
+    # the view has to be gone before the block can be closed
+    del data
+    shm.close()
+    dng = RAW2DNG()
+    dng.options(dng_tags(resolution), path='', compress=False)
+    dng.convert(_image, filename=filename)
+    return slot
+
+class BayerOutput:
+    '''
+    picamera custom output for one still capture which keeps only the raw tail of the stream
+
+    Parameters
+    ----------
+    size   : int
+             Largest possible size of the raw block (including the 'BRCM' header)
+
+    stride : int
+             Bytes per row of the raw data
+    '''
+    def __init__(self, size, stride):
+        self.size = size
+        self.stride = stride
+        self.reset()
+
+    def reset(self):
+        self.chunks = deque()
+        self.length = 0
+
+    def write(self, buf):
+        self.chunks.append(buf)
+        self.length += len(buf)
+        # drop JPEG data which can not be part of the raw tail any more
+        while self.chunks and self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+        return len(buf)
+
+    def copy_to(self, target):
+        '''
+        Copies the raw tail into *target* (a memoryview of at least size bytes)
+
+        Returns
+        -------
+        offset : int
+                 Position of the 'BRCM' header in *target*
+        '''
+        if self.length < self.size:
+            raise ValueError('capture contains no raw data, got {} bytes'.format(self.length))
+        # only the first chunk can start with JPEG data
+        skip = self.length - self.size
+        position = 0
+        for chunk in self.chunks:
+            chunk = memoryview(chunk)[skip:]
+            skip = 0
+            target[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        # the number of padding rows is not known, try all of them
+        for extra in range(MAX_EXTRA_ROWS + 1):
+            offset = (MAX_EXTRA_ROWS - extra) * self.stride
+            if bytes(target[offset:offset + 4]) == b'BRCM':
+                return offset
+        raise ValueError('no BRCM header found in the raw data, does the resolution match the sensor mode?')
+
+class BurstCapture:
+    '''
+    Captures a burst of raw Bayer frames and writes them as DNG in the background
+
+    Parameters
+    ----------
+    resolution : tuple
+                 Width and height of the sensor mode
+
+    buffers    : int
+                 Number of preallocated shared memory buffers
+
+    workers    : int
+                 Number of DNG writer processes
+    '''
+    def __init__(self, resolution, buffers=4, workers=3):
+        self.resolution = resolution
+        self.stride, self.size = raw_geometry(resolution)
+        self.shm = [shared_memory.SharedMemory(create=True, size=self.size) for _ in range(buffers)]
+        self.free = deque(range(buffers))
+        self.pending = deque()
+        # the GUI process runs Tk and picamera threads, so the writers are not forked from it
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.waits = 0
+
+    def _reap(self, block=False):
+        '''
+        Returns the buffers of finished DNG jobs to the free list
+
+        Parameters
+        ----------
+        block : bool
+                Wait for the oldest job if no buffer is free
+
+        Returns
+        -------
+        None
+        '''
+        while self.pending and (self.pending[0].done() or (block and not self.free)):
+            self.free.append(self.pending.popleft().result())
+
+    def capture(self, camera, folder, prefix, frames, jobs=None):
+        '''
+        Captures *frames* raw frames in burst mode
+
+        Parameters
+        ----------
+        camera : picamera.camera.PiCamera
+                 The picamera camera object
+
+        folder : str
+                 Folder for the DNG files
+
+        prefix : str
+                 Start of the file names, the frame number is appended
+
+        frames : int
+                 Number of frames
+
+        jobs   : jobqueue.JobQueue
+                 Post-capture jobs, throttled after every frame and paused while no buffer is free, optional
+
+        Returns
+        -------
+        fps    : float
+                 Sustained frames per second of the capture loop, including the time to finish writing
+        '''
+        output = BayerOutput(self.size, self.stride)
+        start = time.monotonic()
+
+        def outputs():
+            for i in range(frames):
+                output.reset()
+                yield output
+                # the previous capture is finished when the next output is requested
+                self._hand_over(output, folder, prefix, i, jobs)
+
+        camera.capture_sequence(outputs(), format='jpeg', bayer=True, burst=True, quality=10, thumbnail=None)
+        capture_fps = frames / (time.monotonic() - start)
+        while self.pending:
+            self.free.append(self.pending.popleft().result())
+        sustained = frames / (time.monotonic() - start)
+        print('raw burst: {} frames {}x{}, capture {:.2f} fps, sustained {:.2f} fps, waited for the writers {} times'.format(
+            frames, self.resolution[0], self.resolution[1], capture_fps, sustained, self.waits))
+        return sustained
+
+    def _hand_over(self, output, folder, prefix, i, jobs=None):
+        '''
+        Copies the raw data of the last capture into a free buffer and submits the DNG job
+        '''
+        self._reap()
+        if jobs is not None:
+            jobs.monitor(True, not self.free)
+        if not self.free:
+            self.waits += 1
+            self._reap(block=True)
+        slot = self.free.popleft()
+        offset = output.copy_to(self.shm[slot].buf)
+        filename = os.path.join(folder, '{}_{:04d}'.format(prefix, i))
+        self.pending.append(self.pool.submit(write_dng, slot, self.shm[slot].name, offset, self.resolution, filename))
+
+    def close(self):
+        '''
+        Stops the writer processes and releases the shared memory
+        '''
+        self.pool.shutdown()
+        for shm in self.shm:
+            shm.close()
+            shm.unlink()
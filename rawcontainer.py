@@ -0,0 +1,409 @@
+'''
+    Name    : rawcontainer
+
+    Lossless compressed container for raw YUV recordings (.abr).
+
+    Frames are collected in chunks of a few frames. Inside a chunk every frame is stored as the
+    difference to its predecessor and the chunk is compressed with zlib. Chunks do not depend on
+    each other, so they are compressed in parallel by a thread pool (zlib and NumPy release the GIL)
+    while the camera keeps delivering frames, and any frame can be decoded by reading one chunk.
+
+    Layout
+    ------
+    header : magic 'ABRC', version, format (0 = gray, 1 = I420), width, height, frames per chunk
+    chunks : zlib compressed frame deltas
+    index  : (offset, length, first frame, number of frames) of every chunk
+    footer : offset of the index, number of chunks, magic 'ABRI'
+
+    Usage
+    -----
+    python3 rawcontainer.py info Video.abr
+    python3 rawcontainer.py export Video.abr Video.ser   (or .yuv / .gray for plain raw frames)
+'''
+
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rawwriter
+import serfile
+
+HEADER = struct.Struct('<4sHHIII')
+INDEX_ENTRY = struct.Struct('<QQII')
+FOOTER = struct.Struct('<QI4s')
+VERSION = 1
+GRAY = 0
+I420 = 1
+
+# memory of one chunk and of all chunk buffers of a writer, a full resolution I420 frame has 18.5 MB
+CHUNK_BYTES = 8 * 1024 * 1024
+BUFFER_BYTES = 64 * 1024 * 1024
+MAX_CHUNK_FRAMES = 16
+
+def compress_chunk(frames, level=1):
+    '''
+    Delta encodes and compresses a chunk of frames, the deltas are computed in place
+
+    Parameters
+    ----------
+    frames : numpy.ndarray
+             (n, frame bytes) uint8 array, overwritten with the frame deltas
+
+    level  : int
+             zlib compression level, 1 is fast enough for the Pi
+
+    Returns
+    -------
+    data   : bytes
+             The compressed chunk
+    '''
+    # backwards, so every frame is still unchanged when its successor needs it
+    for i in range(len(frames) - 1, 0, -1):
+        np.subtract(frames[i], frames[i - 1], out=frames[i])
+    return zlib.compress(frames, level)
+
+def decompress_chunk(data, frames, frame_bytes):
+    '''
+    Reverses compress_chunk()
+
+    Parameters
+    ----------
+    data        : bytes
+                  The compressed chunk
+
+    frames      : int
+                  Number of frames in the chunk
+
+    frame_bytes : int
+                  Size of a single frame
+
+    Returns
+    -------
+    frames      : numpy.ndarray
+                  (n, frame bytes) uint8 array
+    '''
+    delta = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(frames, frame_bytes)
+    # the uint8 accumulation wraps around exactly like the subtraction did
+    return np.cumsum(delta, axis=0, dtype=np.uint8)
+
+def i420_to_rgb(frame, width, height):
+    '''
+    Converts a single I420 frame into an interleaved RGB image (full range BT.601)
+
+    Parameters
+    ----------
+    frame  : numpy.ndarray
+             Flat uint8 frame without padding
+
+    width  : int
+             Frame width
+
+    height : int
+             Frame height
+
+    Returns
+    -------
+    rgb    : numpy.ndarray
+             (height, width, 3) uint8 array
+    '''
+    n = width * height
+    y = frame[:n].reshape(height, width).astype(np.float32)
+    u = frame[n:n + n // 4].reshape(height // 2, width // 2).astype(np.float32) - 128
+    v = frame[n + n // 4:n + n // 2].reshape(height // 2, width // 2).astype(np.float32) - 128
+    u = u.repeat(2, axis=0).repeat(2, axis=1)
+    v = v.repeat(2, axis=0).repeat(2, axis=1)
+    rgb = np.empty((height, width, 3), dtype=np.float32)
+    rgb[..., 0] = y + 1.402 * v
+    rgb[..., 1] = y - 0.344136 * u - 0.714136 * v
+    rgb[..., 2] = y + 1.772 * u
+    return np.clip(rgb, 0, 255, out=rgb).astype(np.uint8)
+
+class CompressedWriter(rawwriter.RawWriter):
+    '''
+    picamera custom output which crops like RawWriter and stores the frames in the compressed container
+
+    Parameters
+    ----------
+    filename     : str
+                   The .abr file to write to
+
+    resolution   : tuple
+                   Resolution of the camera
+
+    crop         : tuple
+                   (x, y, w, h) region to keep in pixels, None for the full frame
+
+    greyscale    : bool
+                   Store only the Y plane
+
+    chunk_frames : int
+                   Number of frames per independently compressed chunk, derived from CHUNK_BYTES if not given
+
+    workers      : int
+                   Number of compression threads
+
+    level        : int
+                   zlib compression level
+    '''
+    def __init__(self, filename, resolution, crop=None, greyscale=False, chunk_frames=None, workers=3, level=1):
+        super().__init__(None, resolution, crop, greyscale)
+        width, height = self.size
+        self.out_bytes = width * height if greyscale else width * height * 3 // 2
+        if chunk_frames is None:
+            chunk_frames = min(MAX_CHUNK_FRAMES, max(1, CHUNK_BYTES // self.out_bytes))
+        self.chunk_frames = chunk_frames
+        self.level = level
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers)
+        # preallocated chunk buffers, reused once their compression is finished,
+        # enough to keep all threads busy but never more than BUFFER_BYTES
+        buffers = min(2 * workers + 1, max(2, BUFFER_BYTES // (chunk_frames * self.out_bytes)))
+        self.free = [np.empty((chunk_frames, self.out_bytes), dtype=np.uint8) for _ in range(buffers)]
+        self.pending = deque()
+        self.chunk = None
+        self.first = 0
+        self.fill = 0
+        self.index = []
+        self.stalls = 0
+        self.compressed = 0
+        self.start = None
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(b'ABRC', VERSION, GRAY if greyscale else I420, width, height, chunk_frames))
+
+    @property
+    def extension(self):
+        return 'abr'
+
+    @property
+    def behind(self):
+        '''
+        True if all chunk buffers are in use or more chunks are waiting for compression than there are threads
+        '''
+        return not self.free or len(self.pending) > self.workers or super().behind
+
+    def _collect(self, block=False):
+        '''
+        Writes finished chunks to the file, in order
+
+        Parameters
+        ----------
+        block : bool
+                Wait for the oldest chunk if it is not finished yet
+
+        Returns
+        -------
+        None
+        '''
+        while self.pending and (block or self.pending[0][0].done()):
+            future, chunk, first, n = self.pending.popleft()
+            data = future.result()
+            self.index.append((self.file.tell(), len(data), first, n))
+            self.file.write(data)
+            self.compressed += len(data)
+            self.free.append(chunk)
+            block = False
+
+    def _submit(self):
+        '''
+        Hands the current chunk over to the pool
+        '''
+        n = self.fill
+        self.pending.append((self.pool.submit(compress_chunk, self.chunk[:n], self.level), self.chunk, self.first, n))
+        self.chunk = None
+        self.fill = 0
+
+    def write_frame(self, planes):
+        '''
+        Copies the cropped planes into the current chunk
+
+        Parameters
+        ----------
+        planes : List[numpy.ndarray]
+                 2D views as returned by planes()
+
+        Returns
+        -------
+        None
+        '''
+        if self.start is None:
+            self.start = time.monotonic()
+        self._collect()
+        if self.chunk is None:
+            if not self.free:
+                # the pool does not keep up, the camera has to wait
+                self.stalls += 1
+                self._collect(block=True)
+            self.chunk = self.free.pop()
+            self.first = self.frames
+        slot = self.chunk[self.fill]
+        offset = 0
+        for plane in planes:
+            size = plane.size
+            np.copyto(slot[offset:offset + size].reshape(plane.shape), plane)
+            offset += size
+        self.fill += 1
+        if self.fill == self.chunk_frames:
+            self._submit()
+
+    def close(self):
+        '''
+        Compresses the remaining frames, writes index and footer and prints some statistics
+
+        Returns
+        -------
+        None
+        '''
+        if self.file is None:
+            return
+        if self.fill:
+            self._submit()
+        while self.pending:
+            self._collect(block=True)
+        self.pool.shutdown()
+        index_offset = self.file.tell()
+        for offset, length, first, n in self.index:
+            self.file.write(INDEX_ENTRY.pack(offset, length, first, n))
+        self.file.write(FOOTER.pack(index_offset, len(self.index), b'ABRI'))
+        self.file.close()
+        self.file = None
+        if self.frames:
+            elapsed = time.monotonic() - self.start
+            print('compressed writer: {} frames of {}x{}, ratio {:.2f}, {:.1f} fps'.format(
+                self.frames, self.size[0], self.size[1], self.bytes_out / max(self.compressed, 1), self.frames / max(elapsed, 1e-6)))
+            if self.stalls:
+                print('compressed writer: pool fell behind {} times, capture had to wait'.format(self.stalls))
+            else:
+                print('compressed writer: pool kept up in real time')
+
+class ContainerReader:
+    '''
+    Random access to the frames of a compressed container
+
+    Parameters
+    ----------
+    filename : str
+               The .abr file to read
+    '''
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        magic, version, self.format, self.width, self.height, self.chunk_frames = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != b'ABRC' or version != VERSION:
+            raise ValueError('{} is not an AstroBeaver raw container'.format(filename))
+        self.file.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, chunks, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != b'ABRI':
+            raise ValueError('{} has no chunk index, the recording was not closed properly'.format(filename))
+        self.file.seek(index_offset)
+        data = self.file.read(chunks * INDEX_ENTRY.size)
+        self.index = [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(chunks)]
+        self.frames = sum(entry[3] for entry in self.index)
+        pixels = self.width * self.height
+        self.frame_bytes = pixels if self.format == GRAY else pixels * 3 // 2
+        self.cached = (None, None)
+
+    def read_chunk(self, i):
+        '''
+        Decodes chunk *i*
+
+        Returns
+        -------
+        frames : numpy.ndarray
+                 (n, frame bytes) uint8 array
+        '''
+        if self.cached[0] != i:
+            offset, length, first, n = self.index[i]
+            self.file.seek(offset)
+            self.cached = (i, decompress_chunk(self.file.read(length), n, self.frame_bytes))
+        return self.cached[1]
+
+    def frame(self, n):
+        '''
+        Decodes frame *n* by reading only the chunk containing it
+
+        Returns
+        -------
+        frame : numpy.ndarray
+                Flat uint8 frame
+        '''
+        if not 0 <= n < self.frames:
+            raise IndexError('frame {} out of range'.format(n))
+        # chunks have a fixed size, only the last one can be shorter
+        i = n // self.chunk_frames
+        return self.read_chunk(i)[n - self.index[i][2]]
+
+    def __len__(self):
+        return self.frames
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield from self.read_chunk(i)
+
+    def close(self):
+        self.file.close()
+
+def export(source, destination):
+    '''
+    Exports a container to plain raw frames (.yuv/.gray) or to SER
+
+    Parameters
+    ----------
+    source      : str
+                  The .abr file
+
+    destination : str
+                  The file to write, the format is chosen by its extension
+
+    Returns
+    -------
+    frames      : int
+                  Number of exported frames
+    '''
+    reader = ContainerReader(source)
+    with open(destination, 'wb') as f:
+        if destination.lower().endswith('.ser'):
+            color_id = serfile.MONO if reader.format == GRAY else serfile.RGB
+            serfile.write_header(f, reader.width, reader.height, reader.frames, color_id)
+            for frame in reader:
+                if reader.format == GRAY:
+                    f.write(frame)
+                else:
+                    f.write(i420_to_rgb(frame, reader.width, reader.height))
+        else:
+            for i in range(len(reader.index)):
+                f.write(reader.read_chunk(i))
+    reader.close()
+    # keep the recording geometry for the calibration
+    info = rawwriter.read_info(source)
+    if info is not None:
+        with open(destination + '.json', 'w') as f:
+            json.dump(info, f, indent=1)
+    return reader.frames
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or export AstroBeaver raw containers')
+    parser.add_argument('command', choices=['info', 'export'])
+    parser.add_argument('source', help='.abr container')
+    parser.add_argument('destination', nargs='?', help='.ser, .yuv or .gray file for export')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        reader = ContainerReader(args.source)
+        raw = reader.frames * reader.frame_bytes
+        print('{}x{} {}, {} frames in {} chunks, compression ratio {:.2f}'.format(
+            reader.width, reader.height, 'gray' if reader.format == GRAY else 'I420',
+            reader.frames, len(reader.index), raw / max(os.path.getsize(args.source), 1)))
+        reader.close()
+    else:
+        if args.destination is None:
+            parser.error('export needs a destination')
+        start = time.monotonic()
+        frames = export(args.source, args.destination)
+        print('exported {} frames in {:.1f}s'.format(frames, time.monotonic() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+'''
+    Name    : rawwriter
+
+    Compact writer for raw YUV recordings.
+
+    picamera hands over every frame as padded I420 (Y plane followed by the U and V planes,
+    width padded to 32 and height to 16 pixels). The writer crops every frame to the region
+    of interest, drops the padding and, in greyscale mode, the chroma planes. All of this is
+    done with NumPy views on the camera buffer, the remaining rows are written with a single
+    gathering os.writev() call, so no frame data is copied before it hits the disk.
+'''
+
+import json
+import os
+import time
+import numpy as np
+
+# maximum number of buffers os.writev() accepts in one call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# weight of the newest frame in the moving averages of frame interval and write time
+SMOOTHING = 0.1
+
+def padded(resolution, width=32, height=16):
+    '''
+    pads the specified resolution up to the nearest multiple of *width* and *height*,
+    which is the layout picamera uses for raw YUV frames
+
+    Parameters
+    ----------
+    resolution : tuple
+                 The resolution of the camera
+
+    width      : int
+                 The block width
+
+    height     : int
+                 The block height
+
+    Returns
+    -------
+    resolution_tuple : tuple
+                       Padded width and height
+    '''
+    return (
+        ((resolution[0] + (width - 1)) // width) * width,
+        ((resolution[1] + (height - 1)) // height) * height,
+    )
+
+def roi_crop(zoom, resolution):
+    '''
+    converts a picamera zoom rectangle into a pixel crop of a frame with the given resolution
+
+    Offsets and sizes are rounded to even numbers, so the crop also fits the subsampled chroma planes
+
+    Parameters
+    ----------
+    zoom       : tuple
+                 (x, y, w, h) as fractions of the full frame, see camera.zoom
+
+    resolution : tuple
+                 Width and height of the frame
+
+    Returns
+    -------
+    crop       : tuple
+                 (x, y, w, h) in pixels
+    '''
+    width, height = resolution
+    x = min(int(zoom[0] * width) & ~1, width - 2)
+    y = min(int(zoom[1] * height) & ~1, height - 2)
+    w = max(int(round(zoom[2] * width)) & ~1, 2)
+    h = max(int(round(zoom[3] * height)) & ~1, 2)
+    return (x, y, min(w, width - x), min(h, height - y))
+
+def write_info(filename, resolution, crop, sensor_mode, gain, exposure, temperature):
+    '''
+    Writes the recording geometry and settings of a raw capture into a sidecar file (capture + '.json'),
+    they are needed to apply the full field calibration masters to the cropped frames
+
+    Parameters
+    ----------
+    filename    : str
+                  The capture
+
+    resolution  : tuple
+                  Resolution of the camera (full field of the sensor mode)
+
+    crop        : tuple
+                  (x, y, w, h) of the region of interest in pixels, see roi_crop()
+
+    sensor_mode : int
+                  Sensor mode of the camera
+
+    gain        : float
+                  Total gain (analog * digital)
+
+    exposure    : int
+                  Exposure time in microseconds
+
+    temperature : float
+                  Temperature in degree Celsius, may be None
+
+    Returns
+    -------
+    None
+    '''
+    with open(filename + '.json', 'w') as f:
+        json.dump({'resolution': list(resolution), 'crop': list(crop), 'sensor_mode': sensor_mode,
+                   'gain': gain, 'exposure': exposure, 'temperature': temperature}, f, indent=1)
+
+def read_info(filename):
+    '''
+    Reads the sidecar file of a raw capture written by write_info()
+
+    Returns
+    -------
+    info : dict or None
+           None if the capture has no sidecar file
+    '''
+    try:
+        with open(filename + '.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+class RawWriter:
+    '''
+    picamera custom output which writes compact raw frames
+
+    Parameters
+    ----------
+    filename   : str
+                 The file to write to
+
+    resolution : tuple
+                 Resolution of the camera, i.e. the unpadded frame size delivered by picamera
+
+    crop       : tuple
+                 (x, y, w, h) region to keep in pixels, None for the full frame
+
+    greyscale  : bool
+                 Write only the Y plane
+    '''
+    def __init__(self, filename, resolution, crop=None, greyscale=False):
+        self.resolution = resolution
+        self.stride = padded(resolution)
+        self.crop = crop if crop is not None else (0, 0, resolution[0], resolution[1])
+        self.greyscale = greyscale
+        self.frame_bytes = self.stride[0] * self.stride[1] * 3 // 2
+        self.partial = bytearray()
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_frame = None
+        self.interval = None
+        self.busy = 0.0
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) if filename is not None else None
+
+    @property
+    def size(self):
+        '''
+        Width and height of the frames as written to disk
+        '''
+        return (self.crop[2], self.crop[3])
+
+    @property
+    def extension(self):
+        '''
+        File extension matching the written format, 'gray' for luma only and 'yuv' for I420
+        '''
+        return 'gray' if self.greyscale else 'yuv'
+
+    @property
+    def behind(self):
+        '''
+        True if writing a frame takes almost as long as the time between two frames
+        '''
+        return self.interval is not None and self.busy > 0.8 * self.interval
+
+    def planes(self, frame):
+        '''
+        Returns cropped views of the planes of a padded I420 frame
+
+        Parameters
+        ----------
+        frame  : numpy.ndarray
+                 The frame as flat uint8 array
+
+        Returns
+        -------
+        planes : List[numpy.ndarray]
+                 2D views of Y and, unless in greyscale mode, U and V
+        '''
+        pw, ph = self.stride
+        x, y, w, h = self.crop
+        luma = frame[:pw * ph].reshape(ph, pw)
+        planes = [luma[y:y + h, x:x + w]]
+        if not self.greyscale:
+            cw, ch = pw // 2, ph // 2
+            u = frame[pw * ph:pw * ph + cw * ch].reshape(ch, cw)
+            v = frame[pw * ph + cw * ch:pw * ph + 2 * cw * ch].reshape(ch, cw)
+            planes.append(u[y // 2:(y + h) // 2, x // 2:(x + w) // 2])
+            planes.append(v[y // 2:(y + h) // 2, x // 2:(x + w) // 2])
+        return planes
+
+    def write_frame(self, planes):
+        '''
+        Writes the rows of the cropped planes with gathering writes
+
+        Parameters
+        ----------
+        planes : List[numpy.ndarray]
+                 2D views as returned by planes()
+
+        Returns
+        -------
+        None
+        '''
+        rows = [row for plane in planes for row in plane]
+        for i in range(0, len(rows), IOV_MAX):
+            chunk = rows[i:i + IOV_MAX]
+            written = os.writev(self.fd, chunk)
+            # short writes are rare, finish them row by row
+            for row in chunk:
+                if written >= row.nbytes:
+                    written -= row.nbytes
+                    continue
+                os.write(self.fd, row[written:])
+                written = 0
+
+    def write(self, buf):
+        '''
+        Called by picamera for every buffer of the recording
+
+        Parameters
+        ----------
+        buf : bytes
+              Raw frame data, normally exactly one frame
+
+        Returns
+        -------
+        n   : int
+              Number of bytes consumed
+        '''
+        now = time.monotonic()
+        if self.last_frame is not None:
+            self.interval = (now - self.last_frame) if self.interval is None else \
+                (1 - SMOOTHING) * self.interval + SMOOTHING * (now - self.last_frame)
+        self.last_frame = now
+        n = len(buf)
+        if self.partial or n != self.frame_bytes:
+            # collect frames which are handed over in pieces
+            self.partial += buf
+            if len(self.partial) < self.frame_bytes:
+                return n
+            buf, self.partial = bytes(self.partial[:self.frame_bytes]), self.partial[self.frame_bytes:]
+        frame = np.frombuffer(buf, dtype=np.uint8, count=self.frame_bytes)
+        planes = self.planes(frame)
+        self.write_frame(planes)
+        self.frames += 1
+        self.bytes_in += self.frame_bytes
+        self.bytes_out += sum(plane.nbytes for plane in planes)
+        self.busy = (1 - SMOOTHING) * self.busy + SMOOTHING * (time.monotonic() - now)
+        return n
+
+    def flush(self):
+        pass
+
+    def close(self):
+        '''
+        Closes the file and prints some statistics
+
+        Returns
+        -------
+        None
+        '''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.frames:
+            print('raw writer: {} frames of {}x{} {}, {:.1f}% of the camera data written'.format(
+                self.frames, self.size[0], self.size[1], self.extension, 100.0 * self.bytes_out / self.bytes_in))
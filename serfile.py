@@ -0,0 +1,110 @@
+'''
+    Name    : serfile
+
+    Minimal support for the SER video format used by most planetary stacking tools
+    (AutoStakkert!, Registax, PIPP). Only 8 bit MONO and RGB files are written.
+'''
+
+import struct
+from datetime import datetime
+
+HEADER_SIZE = 178
+HEADER = struct.Struct('<14s7i40s40s40sqq')
+FRAME_COUNT_OFFSET = 38
+
+# colour ids of the SER specification
+MONO = 0
+RGB = 100
+
+def _ticks(date):
+    '''
+    Converts a datetime into the 100ns ticks since 0001-01-01 used by SER
+    '''
+    delta = date - datetime(1, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 10**7 + delta.microseconds * 10
+
+def write_header(f, width, height, frames=0, color_id=MONO, depth=8, instrument='Raspberry Pi HQ Camera', date=None):
+    '''
+    Writes a SER header at the current position of *f*
+
+    Parameters
+    ----------
+    f          : file object
+                 File opened for binary writing
+
+    width      : int
+                 Frame width
+
+    height     : int
+                 Frame height
+
+    frames     : int
+                 Number of frames, can be fixed later with set_frame_count()
+
+    color_id   : int
+                 MONO or RGB
+
+    depth      : int
+                 Bits per pixel and plane
+
+    instrument : str
+                 Camera name stored in the header
+
+    date       : datetime
+                 Start of the recording, now if not given
+
+    Returns
+    -------
+    None
+    '''
+    if date is None:
+        date = datetime.now()
+    f.write(HEADER.pack(b'LUCAM-RECORDER', 0, color_id, 0, width, height, depth, frames,
+                        b'', instrument.encode()[:40], b'', _ticks(date), _ticks(datetime.utcnow())))
+
+def read_header(f):
+    '''
+    Reads the SER header at the start of *f*
+
+    Parameters
+    ----------
+    f      : file object
+             File opened for binary reading
+
+    Returns
+    -------
+    header : dict
+             color_id, width, height, depth, frames and the channels per pixel
+    '''
+    f.seek(0)
+    fields = HEADER.unpack(f.read(HEADER_SIZE))
+    if fields[0] != b'LUCAM-RECORDER':
+        raise ValueError('not a SER file')
+    color_id = fields[2]
+    return {'color_id': color_id,
+            'width': fields[4],
+            'height': fields[5],
+            'depth': fields[6],
+            'frames': fields[7],
+            'channels': 3 if color_id in (RGB, RGB + 1) else 1}
+
+def set_frame_count(f, frames):
+    '''
+    Updates the frame count of an already written header
+
+    Parameters
+    ----------
+    f      : file object
+             File opened for binary writing
+
+    frames : int
+             The final number of frames
+
+    Returns
+    -------
+    None
+    '''
+    position = f.tell()
+    f.seek(FRAME_COUNT_OFFSET)
+    f.write(struct.pack('<i', frames))
+    f.seek(position)
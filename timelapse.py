@@ -0,0 +1,168 @@
+'''
+    Name    : timelapse
+
+    Interval capture from the video port.
+
+    Frames are taken from the running video port (no mode switch of the still port) into a
+    small set of preallocated buffers. A background thread encodes and writes them as PNG, so
+    the capture loop only has to wait for the next tick. The deviation of every capture from
+    its schedule (taken when the frame has been captured) is recorded and reported as jitter.
+'''
+
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from PIL import Image
+import rawwriter
+
+# the last milliseconds before a tick are busy waited, sleep() is not accurate enough
+SPIN_TIME = 0.002
+
+class BufferOutput:
+    '''
+    picamera custom output which writes one frame into a preallocated buffer
+
+    Parameters
+    ----------
+    buffer : numpy.ndarray
+             Flat uint8 array large enough for one padded frame
+    '''
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 0
+
+    def write(self, buf):
+        n = len(buf)
+        self.buffer[self.position:self.position + n] = np.frombuffer(buf, dtype=np.uint8)
+        self.position += n
+        return n
+
+class IntervalCapture:
+    '''
+    Captures a frame every *interval* seconds
+
+    Parameters
+    ----------
+    resolution : tuple
+                 Resolution of the camera
+
+    buffers    : int
+                 Number of preallocated frame buffers
+    '''
+    def __init__(self, resolution, buffers=4):
+        self.resolution = resolution
+        self.stride = rawwriter.padded(resolution)
+        self.buffers = [np.empty(self.stride[0] * self.stride[1] * 3, dtype=np.uint8) for _ in range(buffers)]
+        self.free = queue.Queue()
+        for slot in range(buffers):
+            self.free.put(slot)
+        self.jobs = queue.Queue()
+        self.stop = threading.Event()
+        self.jitter = []
+        self.captured = 0
+        self.dropped = 0
+
+    def _writer(self):
+        '''
+        Background thread which encodes and writes the captured frames
+        '''
+        width, height = self.resolution
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            slot, filename = job
+            image = self.buffers[slot].reshape(self.stride[1], self.stride[0], 3)[:height, :width]
+            Image.fromarray(image).save(filename, compress_level=1)
+            self.free.put(slot)
+
+    def _wait(self, tick):
+        '''
+        Waits until the monotonic clock reaches *tick*, returns early if the capture is stopped
+        '''
+        while True:
+            remaining = tick - time.monotonic()
+            if remaining <= 0:
+                return
+            if remaining > SPIN_TIME:
+                self.stop.wait(min(remaining - SPIN_TIME, 0.5))
+                if self.stop.is_set():
+                    return
+
+    def run(self, camera, folder, prefix, interval, frames):
+        '''
+        Captures the sequence, blocks until it is finished or stop is set
+
+        Parameters
+        ----------
+        camera   : picamera.camera.PiCamera
+                   The picamera camera object
+
+        folder   : str
+                   Folder for the PNG files and the time stamp list
+
+        prefix   : str
+                   Start of the file names, the frame number is appended
+
+        interval : float
+                   Seconds between two frames
+
+        frames   : int
+                   Number of frames
+
+        Returns
+        -------
+        None
+        '''
+        writer = threading.Thread(target=self._writer, daemon=True)
+        writer.start()
+        stamps = open(os.path.join(folder, prefix + '_timestamps.csv'), 'w')
+        stamps.write('frame,scheduled/s,captured/s,jitter/ms,time\n')
+        start = time.monotonic() + 0.1
+
+        def outputs():
+            for i in range(frames):
+                tick = start + i * interval
+                self._wait(tick)
+                if self.stop.is_set():
+                    return
+                try:
+                    slot = self.free.get_nowait()
+                except queue.Empty:
+                    # the writer is still busy with all buffers, keep the schedule
+                    self.dropped += 1
+                    continue
+                yield BufferOutput(self.buffers[slot])
+                # picamera asks for the next output once the frame is captured, so the time stamp
+                # includes the wait for the next video port frame and the encoder start
+                now = time.monotonic()
+                self.jitter.append(now - tick)
+                stamps.write('{},{:.3f},{:.3f},{:.2f},{}\n'.format(i, tick - start, now - start, 1000 * (now - tick),
+                                                                  datetime.now().isoformat(timespec='milliseconds')))
+                self.jobs.put((slot, os.path.join(folder, '{}_{:05d}.png'.format(prefix, i))))
+                self.captured += 1
+
+        try:
+            camera.capture_sequence(outputs(), format='rgb', use_video_port=True)
+        finally:
+            self.jobs.put(None)
+            writer.join()
+            stamps.close()
+
+    def report(self):
+        '''
+        Returns a short summary of the timing
+
+        Returns
+        -------
+        summary : str
+                  Number of frames and mean / max / standard deviation of the jitter in ms
+        '''
+        if not self.jitter:
+            return 'no frames captured'
+        jitter = 1000 * np.array(self.jitter)
+        return '{} frames, {} dropped, jitter mean {:.2f} ms, max {:.2f} ms, std {:.2f} ms'.format(
+            self.captured, self.dropped, jitter.mean(), jitter.max(), jitter.std())